@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# Benchmark the hash-indexed Config.diffHosts against the original nested loop updateDB diff
+#
+# Usage: benchmarks/bench_diff.py [--sizes 1000,10000,50000] [--legacy-max 10000]
+
+import argparse
+import logging
+import random
+import sys
+import time
+from os.path import dirname, abspath
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from cloudgazer.Nagios import Config as NagiosConfig
+
+HOST_IDENT = 'host_name'
+NAGIOS_FIELDS = ['use', 'address', 'host_name', 'alias']
+
+
+def make_fleet(size, churn=0.05, seed=42):
+    """
+    Builds a pair of synthetic fleets (stored, discovered). A churn fraction of the
+    stored hosts is removed, updated and added in the discovered fleet.
+    """
+    rnd = random.Random(seed)
+    current = []
+    for i in range(size):
+        name = 'web-i-%08x' % i
+        current.append({'use': 'role-%d' % (i % 20),
+                        'address': '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+                        'host_name': name,
+                        'alias': name})
+    discovered = [dict(h) for h in current]
+    rnd.shuffle(discovered)
+    nchurn = int(size * churn)
+    del discovered[:nchurn]
+    for host in discovered[:nchurn]:
+        host['address'] = '172.16.%d.%d' % (rnd.randint(0, 255), rnd.randint(0, 255))
+    for i in range(nchurn):
+        name = 'web-i-%08x' % (size + i)
+        discovered.append({'use': 'role-new', 'address': '10.255.0.%d' % (i & 255),
+                           'host_name': name, 'alias': name})
+    return current, discovered
+
+
+def legacy_diff(hostIdent, currentHosts, hosts):
+    """
+    The original updateDB comparison, without the database writes
+    """
+    changeList = {}
+    currentHosts2 = currentHosts[:]
+    for nhost in hosts:
+        exists = False
+        for chost in currentHosts:
+            if nhost[hostIdent] == chost[hostIdent]:
+                currentHosts2.remove(chost)
+                exists = True
+                different = []
+                for attrib in nhost:
+                    if attrib == hostIdent:
+                        continue
+                    if not nhost[attrib] == chost[attrib]:
+                        different.append(attrib)
+                if len(different) > 0:
+                    changeList[chost[hostIdent]] = "updated:%s" % (':'.join(different))
+        if not exists:
+            changeList[nhost[hostIdent]] = 'added'
+    for host in currentHosts2:
+        changeList[host[hostIdent]] = 'removed'
+    return changeList
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def main():
+    argParse = argparse.ArgumentParser()
+    argParse.add_argument('--sizes', default='1000,10000,50000',
+                          help='Comma separated fleet sizes to benchmark')
+    argParse.add_argument('--legacy-max', dest='legacyMax', type=int, default=10000,
+                          help='Largest fleet to run the quadratic implementation against')
+    args = argParse.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    nagiosConf = NagiosConfig(configPath=None,
+                              databaseFile=':memory:',
+                              hostIdent=HOST_IDENT,
+                              nagiosFields=NAGIOS_FIELDS)
+
+    print '%10s %14s %14s %10s' % ('hosts', 'indexed (s)', 'legacy (s)', 'speedup')
+    for size in [int(s) for s in args.sizes.split(',')]:
+        current, discovered = make_fleet(size)
+        currentRecords = [nagiosConf.recordType.fromDict(host) for host in current]
+        discoveredRecords = [nagiosConf.recordType.fromDict(host) for host in discovered]
+        (changeList, _, _, _), indexed = timed(nagiosConf.diffHosts, currentRecords, discoveredRecords)
+        if size <= args.legacyMax:
+            legacyList, legacy = timed(legacy_diff, HOST_IDENT, current, discovered)
+            assert legacyList == changeList, 'change lists differ for %d hosts' % size
+            print '%10d %14.4f %14.4f %9.1fx' % (size, indexed, legacy, legacy / max(indexed, 1e-9))
+        else:
+            print '%10d %14.4f %14s %10s' % (size, indexed, 'skipped', '-')
+
+
+if __name__ == '__main__':
+    main()
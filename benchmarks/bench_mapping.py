@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# Microbenchmark of projecting ec2 instances into nagios host dicts with the compiled FieldMapper,
+# against the original per instance build_nagios_field
+#
+# Usage: benchmarks/bench_mapping.py [--instances 50000]
+
+import argparse
+import sys
+import time
+from os.path import dirname, abspath
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from cloudgazer.AWS import FieldMapper
+
+MAPPINGS = {
+    'template': {'nagios_field': 'use', 'ec2_instance_property': 'tag:role'},
+    'address': {'nagios_field': 'address', 'ec2_instance_property': 'private_ip_address'},
+    'hostname': {'nagios_field': 'host_name', 'ec2_instance_property': ['tag:Name', 'id']},
+    'alias': {'nagios_field': 'alias', 'ec2_instance_property': ['tag:Name', 'id']},
+}
+
+
+class FakeInstance(object):
+    __slots__ = ('id', 'private_ip_address', 'tags')
+
+    def __init__(self, i):
+        self.id = 'i-%08x' % i
+        self.private_ip_address = '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255)
+        self.tags = {'Name': 'web%d' % i, 'role': 'role-%d' % (i % 20)}
+
+
+def build_nagios_field(instance, fieldName, fieldProperties):
+    """
+    The original per instance projection, with the multi-part return moved out of the loop
+    """
+    if type(fieldProperties) is list:
+        fieldParts = []
+        for prop in fieldProperties:
+            if prop.startswith('tag:'):
+                tag = prop.split(':')[1]
+                fieldParts.append(str(instance.tags[tag]))
+            else:
+                fieldParts.append(str(getattr(instance, prop)))
+        return '-'.join(fieldParts)
+    elif type(fieldProperties) is str:
+        if fieldProperties.startswith('tag:'):
+            tag = fieldProperties.split(':')[1]
+            return str(instance.tags[tag])
+        else:
+            return str(getattr(instance, fieldProperties))
+
+
+def legacy_project(instance):
+    myhost = {}
+    for map in MAPPINGS:
+        myhost[MAPPINGS[map]['nagios_field']] = build_nagios_field(instance,
+                                                                   MAPPINGS[map]['nagios_field'],
+                                                                   MAPPINGS[map]['ec2_instance_property'])
+    return myhost
+
+
+def timed(project, instances):
+    start = time.time()
+    hosts = [project(inst) for inst in instances]
+    return hosts, time.time() - start
+
+
+def main():
+    argParse = argparse.ArgumentParser()
+    argParse.add_argument('--instances', type=int, default=50000,
+                          help='Number of synthetic instances to project')
+    args = argParse.parse_args()
+
+    instances = [FakeInstance(i) for i in range(args.instances)]
+    mapper = FieldMapper(MAPPINGS)
+    compiledHosts, compiled = timed(mapper.project, instances)
+    legacyHosts, legacy = timed(legacy_project, instances)
+    assert [host.asDict() for host in compiledHosts] == legacyHosts, 'projections differ'
+
+    print '%d instances' % args.instances
+    print '%-10s %10.4f s %8.2f us/instance' % ('compiled', compiled, compiled * 1e6 / args.instances)
+    print '%-10s %10.4f s %8.2f us/instance' % ('legacy', legacy, legacy * 1e6 / args.instances)
+    print 'speedup    %10.1fx' % (legacy / max(compiled, 1e-9))
+
+
+if __name__ == '__main__':
+    main()
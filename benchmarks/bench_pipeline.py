@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# Offline benchmark of the whole cloudgazer pipeline against a synthetic (or recorded) EC2 fleet
+#
+# Generates a fleet of fake instances as a replay snapshot, then runs Cloudgazer.run() against it several times,
+# churning the fleet between runs, with no-op verify/restart commands and a temporary host_dir. Reports the
+# per stage timings and peak RSS of every run.
+#
+# Usage: benchmarks/bench_pipeline.py [--hosts 10000] [--churn 0.01] [--roles 20] [--extra-tags 5] [--runs 5]
+#                                     [--database sqlite|snapshot]
+#        benchmarks/bench_pipeline.py --record snapshot.jsonl -c ~/.cloudgazer.yaml
+#        benchmarks/bench_pipeline.py --replay snapshot.jsonl [--churn 0.01] [--runs 5]
+
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+from os.path import dirname, abspath
+
+import yaml
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from cloudgazer import Cloudgazer
+
+STAGES = ['discovery', 'digest', 'diff', 'update_db', 'write', 'notify', 'verify', 'restart', 'downtime', 'run']
+
+MAPPINGS = {
+    'template': {'nagios_field': 'use', 'ec2_instance_property': 'tag:role'},
+    'address': {'nagios_field': 'address', 'ec2_instance_property': 'private_ip_address'},
+    'hostname': {'nagios_field': 'host_name', 'ec2_instance_property': ['tag:Name', 'id']},
+    'alias': {'nagios_field': 'alias', 'ec2_instance_property': ['tag:Name', 'id']},
+}
+
+
+class FleetGenerator:
+    """
+    Generates DescribeInstances-like instance records, and churns them: each churn removes, adds and readdresses
+    an equal share of the given fraction of the fleet
+    """
+    def __init__(self, roles, extraTags, seed=42):
+        self.roles = roles
+        self.extraTags = extraTags
+        self.random = random.Random(seed)
+        self.nextId = 0
+
+    def instance(self):
+        i = self.nextId
+        self.nextId += 1
+        tags = {'Name': 'web%d' % i, 'role': 'role-%d' % self.random.randrange(self.roles)}
+        for t in range(self.extraTags):
+            tags['tag%d' % t] = 'value-%d' % self.random.randrange(100)
+        return {'id': 'i-%08x' % i,
+                'private_ip_address': self._address(),
+                'instance_type': 'm3.medium',
+                'placement': 'us-west-1a',
+                'state': 'running',
+                'tags': tags}
+
+    def fleet(self, size):
+        return [self.instance() for i in range(size)]
+
+    def churn(self, instances, fraction):
+        count = int(len(instances) * fraction / 3)
+        instances = instances[:]
+        self.random.shuffle(instances)
+        del instances[:count]
+        for i in range(count):
+            instances[i] = dict(instances[i], private_ip_address=self._address())
+        instances.extend([self.instance() for i in range(count)])
+        return instances
+
+    def _address(self):
+        return '10.%d.%d.%d' % (self.random.randrange(256), self.random.randrange(256), self.random.randrange(256))
+
+
+def write_snapshot(path, instances):
+    with open(path, 'w') as f:
+        f.write(''.join([json.dumps(inst) + '\n' for inst in instances]))
+
+
+def read_snapshot(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def drain_pipe(path):
+    # stands in for nagios reading its command pipe
+    def reader():
+        while True:
+            with open(path) as f:
+                f.read()
+    thread = threading.Thread(target=reader)
+    thread.daemon = True
+    thread.start()
+
+
+def bench_config(workDir, snapshot, databaseType='sqlite'):
+    commandFile = os.path.join(workDir, 'nagios.cmd')
+    os.mkfifo(commandFile)
+    drain_pipe(commandFile)
+    os.mkdir(os.path.join(workDir, 'hosts'))
+    return {
+        'ec2': {'region': 'us-west-1', 'assumed_role_arn': None, 'filters': {}, 'replay_file': snapshot},
+        'notifications': {'enabled': False},
+        'database': {'type': databaseType, 'location': os.path.join(workDir, 'cloudgazer.db'),
+                     'journal_mode': 'wal', 'synchronous': 'normal'},
+        'nagios': {'host_dir': os.path.join(workDir, 'hosts'),
+                   'host_identifier': 'host_name',
+                   'separate_hosts_by': 'use',
+                   'incremental_write': True,
+                   'staged_write': True,
+                   'test_config_cmd': 'true',
+                   'restart_cmd': 'true',
+                   'command_file': commandFile,
+                   'downtime_user': '',
+                   'downtime_wait_timeout': 5},
+        'mappings': MAPPINGS,
+        'template_map': None,
+    }
+
+
+def record(configFile, snapshot):
+    with open(os.path.expanduser(configFile)) as f:
+        config = yaml.safe_load(f)
+    config['ec2']['record_file'] = snapshot
+    cloudgazer = Cloudgazer(config)
+    cloudgazer._discover()
+    cloudgazer.close()
+    print 'Recorded %d instances to %s' % (len(cloudgazer.awsHosts.hosts), snapshot)
+
+
+def main():
+    argParse = argparse.ArgumentParser()
+    argParse.add_argument('--hosts', type=int, default=10000, help='Size of the synthetic fleet')
+    argParse.add_argument('--churn', type=float, default=0.01,
+                          help='Fraction of the fleet removed, added or readdressed between runs')
+    argParse.add_argument('--roles', type=int, default=20, help='Number of distinct role tags (config files)')
+    argParse.add_argument('--extra-tags', dest='extraTags', type=int, default=5,
+                          help='Number of extra tags per instance')
+    argParse.add_argument('--runs', type=int, default=5, help='Number of runs, the first one populates')
+    argParse.add_argument('--warm', action='store_true',
+                          help='Reuse one Cloudgazer between runs, as --daemon does, instead of one per run')
+    argParse.add_argument('--database', default='sqlite', choices=['sqlite', 'snapshot'],
+                          help='Database type to store the hosts in')
+    argParse.add_argument('--record', help='Record the fleet discovered with the --config_file to this snapshot')
+    argParse.add_argument('-c', '--config_file', dest='configFile', default='~/.cloudgazer.yaml',
+                          help='Cloudgazer configuration file for --record')
+    argParse.add_argument('--replay', help='Replay this snapshot instead of generating a fleet')
+    args = argParse.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    if args.record:
+        record(args.configFile, args.record)
+        return
+
+    generator = FleetGenerator(args.roles, args.extraTags)
+    instances = read_snapshot(args.replay) if args.replay else generator.fleet(args.hosts)
+
+    workDir = tempfile.mkdtemp()
+    try:
+        snapshot = os.path.join(workDir, 'snapshot.jsonl')
+        config = bench_config(workDir, snapshot, args.database)
+        cloudgazer = None
+        print '%-4s %7s %7s ' % ('run', 'hosts', 'changed') + \
+            ' '.join(['%9s' % stage[:9] for stage in STAGES]) + ' %10s' % 'peak rss'
+        for run in range(args.runs):
+            if run > 0:
+                instances = generator.churn(instances, args.churn)
+            write_snapshot(snapshot, instances)
+            if cloudgazer is not None and not args.warm:
+                cloudgazer.close()
+                cloudgazer = None
+            if cloudgazer is None:
+                cloudgazer = Cloudgazer(config)
+            cloudgazer.run()
+            metrics = cloudgazer.metrics
+            changed = sum([metrics.counters.get('hosts_' + change, 0) for change in ('added', 'removed', 'updated')])
+            peakRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+            print '%-4d %7d %7d ' % (run, len(instances), changed) + \
+                ' '.join(['%9.4f' % metrics.timings.get(stage, 0) for stage in STAGES]) + ' %8.1fMB' % peakRss
+    finally:
+        if cloudgazer is not None:
+            cloudgazer.close()
+        shutil.rmtree(workDir)
+
+
+if __name__ == '__main__':
+    main()
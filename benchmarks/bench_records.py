@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# Benchmark the memory and comparison cost of host records against the plain dict per host they replaced
+#
+# Builds the same fleet as dicts and as host records (sharing the same value strings), and reports the bytes per
+# host of each container, the resident memory each fleet adds (measured in a forked child), and how long comparing
+# and diffing the fleets takes.
+#
+# Usage: benchmarks/bench_records.py [--hosts 50000] [--fields 8]
+
+import argparse
+import gc
+import logging
+import os
+import resource
+import sys
+import time
+from os.path import dirname, abspath
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from cloudgazer.Nagios import Config as NagiosConfig
+
+HOST_IDENT = 'host_name'
+
+
+def make_values(count, fields):
+    rows = []
+    for i in range(count):
+        name = 'web-i-%08x' % i
+        row = ['role-%d' % (i % 20), '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255), name, name]
+        row += ['value-%d-%d' % (f, i % 100) for f in range(fields - len(row))]
+        rows.append(row)
+    return rows
+
+
+def dict_diff(hostIdent, currentHosts, hosts):
+    """
+    Config.diffHosts as it was for dicts
+    """
+    changeList = {}
+    currentIndex = dict((chost[hostIdent], chost) for chost in currentHosts)
+    seen = set()
+    for nhost in hosts:
+        ident = nhost[hostIdent]
+        seen.add(ident)
+        chost = currentIndex.get(ident)
+        if chost is None:
+            changeList[ident] = 'added'
+            continue
+        different = [attrib for attrib in nhost if attrib != hostIdent and not nhost[attrib] == chost[attrib]]
+        if len(different) > 0:
+            changeList[ident] = "updated:%s" % (':'.join(different))
+    for ident in currentIndex:
+        if ident not in seen:
+            changeList[ident] = 'removed'
+    return changeList
+
+
+def rss_growth(build):
+    # build in a forked child, so each representation starts from the same heap
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        hosts = build()
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(write, str(after - before))
+        os._exit(0)
+    os.close(write)
+    growth = int(os.read(read, 64))
+    os.close(read)
+    os.waitpid(pid, 0)
+    return growth * 1024
+
+
+def timed(func, *args):
+    gc.collect()
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def main():
+    argParse = argparse.ArgumentParser()
+    argParse.add_argument('--hosts', type=int, default=50000, help='Number of hosts')
+    argParse.add_argument('--fields', type=int, default=8, help='Number of nagios fields per host (at least 4)')
+    args = argParse.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    fields = ['use', 'address', 'host_name', 'alias'] + ['_FIELD%d' % f for f in range(args.fields - 4)]
+    nagiosConf = NagiosConfig(configPath=None, databaseFile=':memory:', hostIdent=HOST_IDENT, nagiosFields=fields)
+    HostRecord = nagiosConf.recordType
+
+    rows = make_values(args.hosts, len(fields))
+    dicts = [dict(zip(fields, row)) for row in rows]
+    records = [HostRecord(row) for row in rows]
+    # the discovered side, with every 20th host readdressed
+    changedRows = [row[:1] + ['172.16.0.%d' % (i & 255)] + row[2:] if i % 20 == 0 else row[:]
+                   for i, row in enumerate(rows)]
+    changedDicts = [dict(zip(fields, row)) for row in changedRows]
+    changedRecords = [HostRecord(row) for row in changedRows]
+
+    dictBytes = sum([sys.getsizeof(host) for host in dicts])
+    recordBytes = sum([sys.getsizeof(host) for host in records])
+    dictRss = rss_growth(lambda: [dict(zip(fields, row)) for row in rows])
+    recordRss = rss_growth(lambda: [HostRecord(row) for row in rows])
+
+    dictEqual, dictEqualTime = timed(lambda: sum([a == b for a, b in zip(dicts, changedDicts)]))
+    recordEqual, recordEqualTime = timed(lambda: sum([a == b for a, b in zip(records, changedRecords)]))
+    assert dictEqual == recordEqual
+    dictChanges, dictDiffTime = timed(dict_diff, HOST_IDENT, dicts, changedDicts)
+    (recordChanges, _, _, _), recordDiffTime = timed(nagiosConf.diffHosts, records, changedRecords)
+    assert dictChanges == recordChanges, 'change lists differ'
+
+    print '%d hosts, %d fields' % (args.hosts, len(fields))
+    print '%-24s %12s %12s %8s' % ('', 'dict', 'record', 'ratio')
+    print '%-24s %12.1f %12.1f %7.1fx' % ('container bytes/host', float(dictBytes) / args.hosts,
+                                         float(recordBytes) / args.hosts, float(dictBytes) / recordBytes)
+    print '%-24s %12.1f %12.1f %7.1fx' % ('rss growth bytes/host', float(dictRss) / args.hosts,
+                                         float(recordRss) / args.hosts, float(dictRss) / max(recordRss, 1))
+    print '%-24s %12.4f %12.4f %7.1fx' % ('compare all (s)', dictEqualTime, recordEqualTime,
+                                         dictEqualTime / max(recordEqualTime, 1e-9))
+    print '%-24s %12.4f %12.4f %7.1fx' % ('diff (s)', dictDiffTime, recordDiffTime,
+                                         dictDiffTime / max(recordDiffTime, 1e-9))
+
+
+if __name__ == '__main__':
+    main()
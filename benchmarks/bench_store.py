@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# Benchmark the host stores (sqlite and snapshot) against each other, and check they agree
+#
+# Writes the same fleet to each store type, then times opening it, single host lookups, loading every host and
+# applying a diff. Before timing, a run of random diffs is applied to each store (with the host identifier not the
+# first field, so inserts sharing a position have to go in identifier order) and every store is checked against the
+# expected hosts after each one.
+#
+# Usage: benchmarks/bench_store.py [--hosts 50000] [--checks 200]
+
+import argparse
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from os.path import dirname, abspath
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from cloudgazer.Records import makeHostRecord
+from cloudgazer.Store import openStore, STORES
+
+HOST_IDENT = 'host_name'
+# the host identifier deliberately isn't first
+FIELDS = ['use', 'host_name', 'address', 'alias']
+
+
+def check_store(storeType, path, HostRecord, checks, rnd):
+    store = openStore(storeType, path, HOST_IDENT, FIELDS, HostRecord)
+    expected = {}
+    for i in range(checks):
+        idents = sorted(expected)
+        removed = [expected[ident] for ident in rnd.sample(idents, min(len(idents), rnd.randrange(3)))]
+        kept = [ident for ident in idents if ident not in set([host.ident() for host in removed])]
+        updated = [HostRecord(['role-%d' % rnd.randrange(5), ident, 'u%d' % i, ''])
+                   for ident in rnd.sample(kept, min(len(kept), rnd.randrange(3)))]
+        added = []
+        # a few hosts next to each other, so they share an insert position
+        start = rnd.randrange(1000)
+        for ident in ['web%04d' % n for n in range(start, start + rnd.randrange(5))]:
+            if ident not in expected:
+                added.append(HostRecord(['role-%d' % rnd.randrange(5), ident, '10.0.0.%d' % i, 'a']))
+        for host in removed:
+            del expected[host.ident()]
+        for host in added + updated:
+            expected[host.ident()] = host
+        store.applyChanges(added, updated, removed)
+        assert sorted(store.load()) == sorted(expected.values()), "%s differs after change %d" % (storeType, i)
+        for ident in rnd.sample(sorted(expected), min(len(expected), 5)):
+            assert store.get(ident) == expected[ident], "%s get(%s) differs after change %d" % (storeType, ident, i)
+    store.close()
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def main():
+    argParse = argparse.ArgumentParser()
+    argParse.add_argument('--hosts', type=int, default=50000, help='Number of hosts')
+    argParse.add_argument('--checks', type=int, default=200, help='Number of random diffs to check each store with')
+    args = argParse.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    HostRecord = makeHostRecord(FIELDS, HOST_IDENT)
+    hosts = [HostRecord(['role-%d' % (i % 20), 'web-%08d' % i, '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+                         'web-%08d' % i]) for i in range(args.hosts)]
+    changed = hosts[::100]
+    updated = [HostRecord([host[0], host[1], '172.16.0.1', host[3]]) for host in changed]
+
+    workDir = tempfile.mkdtemp()
+    try:
+        for storeType in sorted(STORES):
+            check_store(storeType, os.path.join(workDir, 'check-' + storeType), HostRecord, args.checks,
+                        random.Random(1))
+        print '%d hosts, %d random diffs checked on each store' % (args.hosts, args.checks)
+        print '%-10s %10s %10s %10s %10s %10s %10s' % ('store', 'write', 'open', 'get', 'load', 'apply', 'size')
+        for storeType in sorted(STORES):
+            path = os.path.join(workDir, storeType)
+            store = openStore(storeType, path, HOST_IDENT, FIELDS, HostRecord)
+            _, writeTime = timed(store.replace, hosts)
+            store.close()
+            store, openTime = timed(openStore, storeType, path, HOST_IDENT, FIELDS, HostRecord)
+            _, getTime = timed(store.get, hosts[args.hosts // 2].ident())
+            loaded, loadTime = timed(store.load)
+            assert len(loaded) == args.hosts
+            _, applyTime = timed(store.applyChanges, [], updated, [])
+            store.close()
+            print '%-10s %10.4f %10.6f %10.6f %10.4f %10.4f %9.1fMB' % (storeType, writeTime, openTime, getTime,
+                                                                     loadTime, applyTime,
+                                                                     os.path.getsize(path) / 1048576.0)
+    finally:
+        shutil.rmtree(workDir)
+
+
+if __name__ == '__main__':
+    main()
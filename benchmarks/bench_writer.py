@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# Benchmark rendering nagios host config with Writer against the original per host string building
+#
+# Usage: benchmarks/bench_writer.py [--hosts 50000] [--buckets 20]
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from os.path import dirname, abspath
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from cloudgazer.Nagios import Writer as NagiosWriter
+from cloudgazer.Records import makeHostRecord
+
+
+def make_hosts(count, buckets):
+    hosts = []
+    for i in range(count):
+        name = 'web-i-%08x' % i
+        hosts.append({'use': 'role-%d' % (i % buckets),
+                      'address': '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+                      'host_name': name,
+                      'alias': name})
+    return hosts
+
+
+def legacy_convert(host):
+    hostStr = 'define host {\n'
+    longestField = 0
+    for field in host:
+        if len(field) > longestField:
+            longestField = len(field)
+    for field in host:
+        tabStr = '' + '\t' * ((longestField / 4) - (len(field) / 4))
+        hostStr += "\t%s\t\t%s%s\n" % (field, tabStr, host[field])
+    hostStr += '}\n\n'
+    return hostStr
+
+
+def legacy_write(configDir, hosts, splitBy):
+    """
+    The original Writer body
+    """
+    newFiles = {}
+    for host in hosts:
+        filename = "cloudgazer_%s.cfg" % (host[splitBy])
+        if filename not in newFiles:
+            newFiles[filename] = legacy_convert(host)
+        else:
+            newFiles[filename] += legacy_convert(host)
+    for file in newFiles:
+        new_host_cfg_path = os.path.join(configDir, file)
+        with open(new_host_cfg_path, 'w') as f:
+            f.write(newFiles[file])
+            if os.path.isfile(new_host_cfg_path + '.services'):
+                with open(new_host_cfg_path + '.services') as svc_file:
+                    for l in svc_file:
+                        f.write(l)
+
+
+def read_tree(path):
+    tree = {}
+    for f in os.listdir(path):
+        with open(os.path.join(path, f)) as fo:
+            tree[f] = fo.read()
+    return tree
+
+
+def main():
+    argParse = argparse.ArgumentParser()
+    argParse.add_argument('--hosts', type=int, default=50000, help='Number of hosts to render')
+    argParse.add_argument('--buckets', type=int, default=20, help='Number of separate_hosts_by files')
+    args = argParse.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    hosts = make_hosts(args.hosts, args.buckets)
+    # the legacy writer used the dict's field order
+    HostRecord = makeHostRecord(hosts[0].keys())
+    records = [HostRecord.fromDict(host) for host in hosts]
+    newDir = tempfile.mkdtemp()
+    legacyDir = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        writer = NagiosWriter(configDir=newDir, hosts=records, changedHosts={}, splitBy='use',
+                              nagiosFields=list(HostRecord.FIELDS))
+        rendered = time.time() - start
+
+        start = time.time()
+        legacy_write(legacyDir, hosts, 'use')
+        legacy = time.time() - start
+
+        assert read_tree(newDir) == read_tree(legacyDir), 'rendered config differs'
+        print '%d hosts in %d files, %d bytes' % (args.hosts, len(writer.filesWritten), writer.bytesWritten)
+        print '%-10s %10.4f s' % ('writer', rendered)
+        print '%-10s %10.4f s' % ('legacy', legacy)
+        print 'speedup    %10.1fx' % (legacy / max(rendered, 1e-9))
+    finally:
+        shutil.rmtree(newDir)
+        shutil.rmtree(legacyDir)
+
+
+if __name__ == '__main__':
+    main()
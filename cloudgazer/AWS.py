@@ -1,72 +1,366 @@
+import json
 import logging
+from operator import attrgetter
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from urlparse import urlparse
+import boto
 from boto import ec2
+from boto.ec2.connection import EC2Connection
+from boto.ec2.regioninfo import RegionInfo
+from boto.exception import BotoClientError, BotoServerError
 from boto.sts import STSConnection
 from boto import sns
 import uuid
+from Metrics import Metrics
+from Records import makeHostRecord
+from Util import backoffDelay
 
 
 class Hosts:
-    def __init__(self, region, assumed_role_arn, filters, mappings, templateMap, exclude_tag):
+    # refresh assumed role credentials when they are this close (in seconds) to expiring
+    CREDENTIAL_REFRESH = 300
+    # instance ids per DescribeInstances call when fetching changed instances
+    IDS_PER_CALL = 200
+
+    def __init__(self, region, assumed_role_arn, filters, mappings, templateMap, exclude_tag,
+                 maxWorkers=8, callTimeout=30, retries=3, pageSize=500, endpoint=None, metrics=None,
+                 recordFile=None, replayFile=None, recordType=None, profiler=None):
+        """
+        Discovers the instances in every region of every account (assumed role) given, in parallel on a pool of at
+        most maxWorkers threads. region and assumed_role_arn may each be a single value or a list, an empty
+        assumed_role_arn uses the credentials boto finds itself.
+        Each AWS call times out after callTimeout seconds and is retried with backoff up to retries times.
+        Instances are fetched pageSize at a time and projected straight into hosts, so only one page of boto
+        instance objects per region is held at once. endpoint overrides the EC2 endpoint, i.e. a local stub.
+        hostOrigins holds the account and region of each entry in hosts.
+        Call refresh() to discover again; assumed role credentials and connections are reused until the
+        credentials are close to expiring. STS, DescribeInstances and projection times and the number of API pages
+        are recorded in metrics.
+        recordFile saves every discovered instance to a JSON lines snapshot, and replayFile discovers the instances
+        in such a snapshot instead of calling AWS at all.
+        applyEvents() updates hosts for just the instances named in state change events, instead of refresh().
+        Each host is a recordType record (see FieldMapper).
+        With a profiler (see Metrics.Profiler) the discovery done on the pool is profiled too.
+        """
         self.logger = logging.getLogger(__name__)
-        self.region = region
-        self.assumed_role_arn = assumed_role_arn
+        self.regions = region if type(region) is list else [region]
+        self.assumed_role_arns = assumed_role_arn if type(assumed_role_arn) is list else [assumed_role_arn]
         self.filters = filters
+        self.fieldMapper = FieldMapper(mappings, recordType=recordType)
         self.exclude_tag = exclude_tag
+        self.maxWorkers = maxWorkers
+        self.retries = retries
+        self.pageSize = pageSize
+        self.endpoint = endpoint
+        self.metrics = metrics or Metrics()
+        self.recordFile = recordFile
+        self.replayFile = replayFile
+        self.profiler = profiler
+        self._recorder = None
+        self._recordLock = threading.Lock()
+        self.hosts = []
+        self.hostOrigins = []
+        self.instanceIds = []
+        self._credentials = {}
+        self._connections = {}
+
+        # boto reads its socket timeout from its config when it opens a connection
+        if not boto.config.has_section('Boto'):
+            boto.config.add_section('Boto')
+        boto.config.set('Boto', 'http_socket_timeout', str(callTimeout))
+
+        try:
+            self.refresh()
+        except (BotoClientError, BotoServerError, IOError) as e:
+            self.logger.critical("Unable to discover EC2 instances: %s" % (e))
+            exit(1)
+
+    def refresh(self):
+        """
+        Discovers the instances again, replacing hosts and hostOrigins. Raises the AWS error if discovery fails.
+        """
+        targets = [(arn, region) for arn in self.assumed_role_arns for region in self.regions]
+        # a single account and region doesn't need the pool, which takes ~0.1s to shut down
+        pool = ThreadPool(min(self.maxWorkers, len(targets))) if len(targets) > 1 else None
+        mapper = pool.map if pool else map
+        if pool and self.profiler:
+            mapper = lambda func, items: pool.map(lambda item: self.profiler.call(func, item), items)
+        if self.recordFile:
+            self._recorder = open(self.recordFile, 'w')
+        try:
+            credentials = dict(zip(self.assumed_role_arns, mapper(self._assumeRole, self.assumed_role_arns)))
+            results = mapper(lambda target: self._discover(target, credentials[target[0]]), targets)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+            if self._recorder:
+                self._recorder.close()
+                self._recorder = None
+
         self.hosts = []
+        self.hostOrigins = []
+        self.instanceIds = []
+        for (arn, region), (hosts, instanceIds) in zip(targets, results):
+            account = self._getAccount(arn)
+            self.logger.debug("Found %d instances in account %s, region %s" % (len(hosts), account, region))
+            self.hosts.extend(hosts)
+            self.hostOrigins.extend([{'account': account, 'region': region}] * len(hosts))
+            self.instanceIds.extend(instanceIds)
+
+    def applyEvents(self, events):
+        """
+        Takes (account, region, instance id) state change events and fetches just those instances again, updating,
+        adding or removing them in hosts. An instance that no longer matches our filters is removed. An event with no
+        account applies to every account in its region. Returns the number of hosts updated, added or removed.
+        Raises the AWS error if fetching fails.
+        """
+        targets = {}
+        for arn in self.assumed_role_arns:
+            for region in self.regions:
+                ids = set([instanceId for account, eventRegion, instanceId in events
+                           if eventRegion == region and (not arn or account in (None, self._getAccount(arn)))])
+                if ids:
+                    targets[(arn, region)] = sorted(ids)
+
+        found = {}
+        for (arn, region), ids in targets.items():
+            credentials = self._assumeRole(arn)
+            ec2Conn = self._connection((arn, region), credentials)
+            origin = {'account': self._getAccount(arn), 'region': region}
+            for i in range(0, len(ids), self.IDS_PER_CALL):
+                filters = dict(self.filters or {}, **{'instance-id': ids[i:i + self.IDS_PER_CALL]})
+                for page in self.iter_pages(ec2Conn, filters=filters):
+                    for inst in page:
+                        found[inst.id] = (self.fieldMapper.project(inst), origin)
+
+        requested = set([instanceId for ids in targets.values() for instanceId in ids])
+        changes = 0
+        removed = set()
+        for index, instanceId in enumerate(self.instanceIds):
+            if instanceId not in requested:
+                continue
+            if instanceId in found:
+                host, origin = found.pop(instanceId)
+                changes += host != self.hosts[index]
+                self.hosts[index] = host
+                self.hostOrigins[index] = origin
+            else:
+                removed.add(index)
+        if removed:
+            keep = [index for index in range(len(self.hosts)) if index not in removed]
+            self.hosts = [self.hosts[index] for index in keep]
+            self.hostOrigins = [self.hostOrigins[index] for index in keep]
+            self.instanceIds = [self.instanceIds[index] for index in keep]
+        for instanceId, (host, origin) in found.items():
+            self.hosts.append(host)
+            self.hostOrigins.append(origin)
+            self.instanceIds.append(instanceId)
+        return changes + len(removed) + len(found)
+
+    def _getAccount(self, assumed_role_arn):
+        return assumed_role_arn.split(':')[4] if assumed_role_arn else 'default'
+
+    def _assumeRole(self, assumed_role_arn):
+        if not assumed_role_arn or self.replayFile:
+            return None
+        credentials = self._credentials.get(assumed_role_arn)
+        if credentials and not credentials.is_expired(time_offset_seconds=self.CREDENTIAL_REFRESH):
+            return credentials
+        self.logger.debug("Assuming role %s" % (assumed_role_arn))
+        with self.metrics.timer('sts'):
+            assumedRoleObject = self._withRetries(STSConnection().assume_role,
+                                                  role_arn=assumed_role_arn,
+                                                  role_session_name="assumeRole_" + uuid.uuid4().urn[-12:])
+        self._credentials[assumed_role_arn] = assumedRoleObject.credentials
+        return assumedRoleObject.credentials
+
+    def _connect(self, region, credentials):
+        keys = {}
+        if credentials:
+            keys = {'aws_access_key_id': credentials.access_key,
+                    'aws_secret_access_key': credentials.secret_key,
+                    'security_token': credentials.session_token}
+        if self.endpoint:
+            url = urlparse(self.endpoint)
+            return EC2Connection(region=RegionInfo(name=region, endpoint=url.hostname),
+                                 port=url.port,
+                                 is_secure=(url.scheme == 'https'),
+                                 path=url.path or '/',
+                                 **keys)
+        return ec2.connect_to_region(region, **keys)
+
+    def _connection(self, target, credentials):
+        if self.replayFile:
+            return ReplayConnection(self.replayFile, account=self._getAccount(target[0]), region=target[1])
+        # reuse the connection for this account and region until its credentials are replaced
+        cached = self._connections.get(target)
+        if cached and cached[0] is credentials:
+            return cached[1]
+        ec2Conn = self._connect(target[1], credentials)
+        self._connections[target] = (credentials, ec2Conn)
+        return ec2Conn
 
-        assumedRoleObject = STSConnection().assume_role(
-            role_arn=self.assumed_role_arn,
-            role_session_name="assumeRole_" + uuid.uuid4().urn[-12:]
-        )
-
-        ec2Conn = ec2.connect_to_region(
-            self.region,
-            aws_access_key_id=assumedRoleObject.credentials.access_key,
-            aws_secret_access_key=assumedRoleObject.credentials.secret_key,
-            security_token=assumedRoleObject.credentials.session_token
-        )
-
-        self.reservations = ec2Conn.get_all_instances(filters=filters)
-        self.instances = [inst for res in self.reservations
-                          for inst in res.instances
-                          if self.exclude_tag not in inst.tags]
-
-        for inst in self.instances:
-            myhost = {}
-            for map in mappings:
-                myhost[mappings[map]['nagios_field']] = self.build_nagios_field(inst,
-                                                                                mappings[map]['nagios_field'],
-                                                                                mappings[map]['ec2_instance_property'])
-            self.hosts.append(myhost)
-
-    def build_nagios_field(self, instance, fieldName, fieldProperties):
+    def _discover(self, target, credentials):
+        ec2Conn = self._connection(target, credentials)
+        hosts = []
+        instanceIds = []
+        for page in self.iter_pages(ec2Conn):
+            if self._recorder:
+                self._record(page, self._getAccount(target[0]), target[1])
+            with self.metrics.timer('projection'):
+                hosts.extend([self.fieldMapper.project(inst) for inst in page])
+            instanceIds.extend([inst.id for inst in page])
+        return hosts, instanceIds
+
+    def _record(self, page, account, region):
+        # keep the plain attributes and tags of each instance, which is all the mappings can use
+        lines = []
+        for inst in page:
+            record = dict((attr, value) for attr, value in vars(inst).items()
+                          if not attr.startswith('_') and isinstance(value, (basestring, int, long, float, bool)))
+            # boto exposes these as properties over private attributes
+            for attr in ('state', 'state_code', 'placement', 'placement_group', 'placement_tenancy'):
+                if hasattr(inst, attr):
+                    record[attr] = getattr(inst, attr)
+            record['tags'] = dict(inst.tags)
+            record['_account'] = account
+            record['_region'] = region
+            lines.append(json.dumps(record) + '\n')
+        with self._recordLock:
+            self._recorder.write(''.join(lines))
+
+    def iter_pages(self, ec2Conn, filters=None):
         """
-        Takes an ec2 instance object, field properties (to map the nagios field to instance attribute(s) ) and a nagios field name.
-        Returns the field name for the provided instance object
+        Generator over pages of the instances matching our filters (or the filters given), following NextToken
         """
-        if type(fieldProperties) is list:
-            fieldParts = []
-            for prop in fieldProperties:
-                if prop.startswith('tag:'):
-                    tag = prop.split(':')[1]
-                    fieldParts.append(str(instance.tags[tag]))
-                else:
-                    try:
-                        fieldParts.append(str(getattr(instance, prop)))
-                    except AttributeError:
-                        self.logger.critical("Unable to find instance attribute %s when building nagios field %s" % (prop, fieldName))
-                        exit(1)
-                    return '-'.join(fieldParts)
-        elif type(fieldProperties) is str:
-            if fieldProperties.startswith('tag:'):
-                tag = fieldProperties.split(':')[1]
-                return str(instance.tags[tag])
+        nextToken = None
+        while True:
+            with self.metrics.timer('describe_instances'):
+                reservations = self._withRetries(ec2Conn.get_all_reservations,
+                                                 filters=filters or self.filters,
+                                                 max_results=self.pageSize,
+                                                 next_token=nextToken)
+            self.metrics.incr('api_pages')
+            yield [inst for res in reservations
+                   for inst in res.instances
+                   if self.exclude_tag not in inst.tags]
+            nextToken = reservations.next_token
+            if not nextToken:
+                break
+
+    def _withRetries(self, func, **kwargs):
+        for attempt in range(self.retries + 1):
+            try:
+                return func(**kwargs)
+            except (BotoClientError, BotoServerError, IOError) as e:
+                if attempt == self.retries:
+                    raise
+                delay = backoffDelay(attempt)
+                self.logger.warning("AWS call failed (%s), retrying in %.1f seconds" % (e, delay))
+                time.sleep(delay)
+
+
+class ReplayConnection:
+    """
+    Stands in for an EC2 connection, serving the instances in a JSON lines snapshot (as saved by Hosts with
+    recordFile, or generated) a page at a time like DescribeInstances. Only the instance-id filter is applied, the
+    snapshot is assumed to hold only matching instances. Records tagged with an _account or _region are only served
+    for it. The snapshot is read when the connection is made, so a new connection sees any changes to it.
+    """
+    def __init__(self, snapshotFile, account=None, region=None):
+        self.instances = []
+        with open(snapshotFile) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record.get('_account', account) == account and record.get('_region', region) == region:
+                    self.instances.append(record)
+
+    def get_all_reservations(self, filters=None, max_results=None, next_token=None):
+        instances = self.instances
+        if filters and 'instance-id' in filters:
+            ids = set(filters['instance-id'])
+            instances = [record for record in instances if record.get('id') in ids]
+        start = int(next_token or 0)
+        end = start + (max_results or len(instances))
+        page = ReplayPage([ReplayReservation([ReplayInstance(record) for record in instances[start:end]])])
+        page.next_token = str(end) if end < len(instances) else None
+        return page
+
+
+class ReplayPage(list):
+    next_token = None
+
+
+class ReplayReservation:
+    def __init__(self, instances):
+        self.instances = instances
+
+
+class ReplayInstance:
+    def __init__(self, record):
+        self.tags = {}
+        for attr, value in record.items():
+            if not attr.startswith('_'):
+                setattr(self, attr, value)
+
+
+class FieldMapper:
+    """
+    Compiles the mappings block once into a list of (nagios field, accessor) pairs, so projecting an instance is just
+    a few direct lookups. Each ec2_instance_property is either 'tag:<name>' or an instance attribute (dotted paths
+    are allowed); a list of properties is joined with '-'. Missing tags and attributes get the mapping's default,
+    or missingValue if it has none.
+    Instances are projected into recordType host records, which hold the nagios fields in their order. By default
+    the record type has the fields in the order of the mappings.
+    """
+    def __init__(self, mappings, missingValue='', recordType=None):
+        self.logger = logging.getLogger(__name__)
+        self.fields = []
+        for map in mappings:
+            fieldName = mappings[map]['nagios_field']
+            fieldProperties = mappings[map]['ec2_instance_property']
+            default = str(mappings[map].get('default', missingValue))
+            if isinstance(fieldProperties, basestring):
+                fieldProperties = [fieldProperties]
+            getters = [self._compileProperty(prop, fieldName, default) for prop in fieldProperties]
+            if len(getters) == 1:
+                accessor = getters[0]
             else:
-                try:
-                    return str(getattr(instance, fieldProperties))
-                except AttributeError:
-                    self.logger.critical("Unable to find instance attribute %s when building nagios field %s" % (fieldProperties, fieldName))
-                    exit(1)
+                accessor = lambda instance, getters=getters: '-'.join([get(instance) for get in getters])
+            self.fields.append((fieldName, accessor))
+        self.recordType = recordType or makeHostRecord([fieldName for fieldName, accessor in self.fields])
+        self.fields.sort(key=lambda field: self.recordType.INDEX[field[0]])
+        self.accessors = [accessor for fieldName, accessor in self.fields]
+
+    def project(self, instance):
+        """
+        Takes an ec2 instance object and returns its nagios host record
+        """
+        return self.recordType([accessor(instance) for accessor in self.accessors])
+
+    def _compileProperty(self, prop, fieldName, default):
+        if prop.startswith('tag:'):
+            tag = prop[len('tag:'):]
+            return lambda instance: str(instance.tags.get(tag, default))
+
+        getter = attrgetter(prop)
+        warned = []
+
+        def getAttribute(instance):
+            try:
+                return str(getter(instance))
+            except AttributeError:
+                if not warned:
+                    self.logger.warning("Unable to find instance attribute %s when building nagios field %s,"
+                                        " using default '%s'" % (prop, fieldName, default))
+                    warned.append(prop)
+                return default
+        return getAttribute
 
 
 class SNSNotify:
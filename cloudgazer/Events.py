@@ -0,0 +1,97 @@
+import json
+import logging
+import os.path
+from boto import sqs
+from boto.sqs.message import RawMessage
+
+
+def parseEvent(body):
+    """
+    Takes an EC2 Instance State-change Notification (as sent by CloudWatch Events, possibly wrapped in an SNS
+    notification) and returns (account, region, instance id), or None if it isn't one
+    """
+    event = json.loads(body)
+    if 'detail' not in event and 'Message' in event:
+        event = json.loads(event['Message'])
+    instanceId = (event.get('detail') or {}).get('instance-id')
+    if not instanceId:
+        return None
+    return (event.get('account'), event.get('region'), instanceId)
+
+
+class SpoolEvents:
+    """
+    Reads state change events from a JSON lines spool file, one event per line. Producers should append each
+    event with a single write. poll() moves the spool aside to <spoolFile>.processing and returns its events,
+    ack() deletes it once they have been applied; events that were never acked are returned again.
+    """
+    def __init__(self, spoolFile):
+        self.logger = logging.getLogger(__name__)
+        self.spoolFile = spoolFile
+        self.processingFile = spoolFile + '.processing'
+
+    def poll(self):
+        if not os.path.exists(self.processingFile):
+            if not os.path.exists(self.spoolFile):
+                return []
+            os.rename(self.spoolFile, self.processingFile)
+        events = []
+        with open(self.processingFile) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    event = parseEvent(line)
+                except ValueError:
+                    self.logger.warning("Ignoring malformed event in %s: %s" % (self.processingFile, line.strip()))
+                    continue
+                if event:
+                    events.append(event)
+        return events
+
+    def ack(self):
+        if os.path.exists(self.processingFile):
+            os.remove(self.processingFile)
+
+
+class SQSEvents:
+    """
+    Receives state change events from an SQS queue, up to maxMessages per poll. Messages are deleted by ack(),
+    so if a run fails they become visible again and are redelivered.
+    """
+    def __init__(self, queueName, region, maxMessages=1000, waitTime=0):
+        self.logger = logging.getLogger(__name__)
+        self.maxMessages = maxMessages
+        self.waitTime = waitTime
+        self.received = []
+        self.queue = sqs.connect_to_region(region).get_queue(queueName)
+        if self.queue is None:
+            self.logger.critical("SQS queue %s not found in %s" % (queueName, region))
+            exit(1)
+        # the events are plain JSON, not boto's base64 encoded messages
+        self.queue.set_message_class(RawMessage)
+
+    def poll(self):
+        waitTime = self.waitTime
+        while len(self.received) < self.maxMessages:
+            messages = self.queue.get_messages(num_messages=min(10, self.maxMessages - len(self.received)),
+                                               wait_time_seconds=waitTime)
+            if not messages:
+                break
+            self.received.extend(messages)
+            waitTime = 0
+        events = []
+        for message in self.received:
+            try:
+                event = parseEvent(message.get_body())
+            except ValueError:
+                self.logger.warning("Ignoring malformed event: %s" % (message.get_body()))
+                continue
+            if event:
+                events.append(event)
+        return events
+
+    def ack(self):
+        for i in range(0, len(self.received), 10):
+            self.queue.delete_message_batch(self.received[i:i + 10])
+        self.received = []
@@ -0,0 +1,152 @@
+import cProfile
+import logging
+import os.path
+import pstats
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from Util import writeAtomically
+
+
+class Metrics:
+    """
+    Collects per stage timings and counters for a cloudgazer run, and exports them to a Prometheus textfile
+    collector file and/or StatsD. Timings for a stage run more than once (or from several threads) are summed.
+    Call reset() at the start of each run.
+    """
+    def __init__(self, prefix='cloudgazer'):
+        self.logger = logging.getLogger(__name__)
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.timings = {}
+            self.counters = {}
+            self.gauges = {}
+
+    @contextmanager
+    def timer(self, stage):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.addTiming(stage, time.time() - started)
+
+    def timed(self, stage):
+        """
+        Decorator version of timer
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(stage):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def addTiming(self, stage, seconds):
+        with self._lock:
+            self.timings[stage] = self.timings.get(stage, 0) + seconds
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def writePrometheus(self, path):
+        """
+        Writes this run's metrics in the Prometheus text format, replacing path atomically as the textfile
+        collector expects
+        """
+        lines = ["# HELP %s_stage_duration_seconds Time spent in each stage of the last run" % (self.prefix),
+                 "# TYPE %s_stage_duration_seconds gauge" % (self.prefix)]
+        for stage in sorted(self.timings):
+            lines.append('%s_stage_duration_seconds{stage="%s"} %f' % (self.prefix, stage, self.timings[stage]))
+        values = dict(self.counters)
+        values.update(self.gauges)
+        for name in sorted(values):
+            lines.append("# TYPE %s_%s gauge" % (self.prefix, name))
+            lines.append("%s_%s %s" % (self.prefix, name, values[name]))
+        lines.append("# TYPE %s_last_run_timestamp_seconds gauge" % (self.prefix))
+        lines.append("%s_last_run_timestamp_seconds %d" % (self.prefix, time.time()))
+        writeAtomically(path, '\n'.join(lines) + '\n')
+
+    def sendStatsd(self, host, port=8125):
+        """
+        Sends this run's timings (ms), counters (c) and gauges (g) to StatsD over UDP
+        """
+        lines = ["%s.stage.%s:%d|ms" % (self.prefix, stage, self.timings[stage] * 1000) for stage in self.timings]
+        lines += ["%s.%s:%s|c" % (self.prefix, name, self.counters[name]) for name in self.counters]
+        lines += ["%s.%s:%s|g" % (self.prefix, name, self.gauges[name]) for name in self.gauges]
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            # keep each packet well under a typical MTU
+            packet = []
+            for line in lines:
+                if packet and len('\n'.join(packet + [line])) > 1400:
+                    sock.sendto('\n'.join(packet), (host, port))
+                    packet = []
+                packet.append(line)
+            if packet:
+                sock.sendto('\n'.join(packet), (host, port))
+        except socket.error as e:
+            self.logger.warning("Unable to send metrics to statsd at %s:%s: %s" % (host, port, e))
+        finally:
+            sock.close()
+
+    def export(self, config):
+        """
+        Exports to wherever the metrics config section asks for
+        """
+        try:
+            if config.get('prometheus_textfile'):
+                self.writePrometheus(os.path.expanduser(config['prometheus_textfile']))
+        except (IOError, OSError) as e:
+            self.logger.warning("Unable to write prometheus metrics: %s" % (e))
+        if config.get('statsd_host'):
+            self.sendStatsd(config['statsd_host'], config.get('statsd_port', 8125))
+
+
+class Profiler:
+    """
+    Profiles the whole run with cProfile. A cProfile profile only sees the thread that enabled it, so work run on
+    pool threads is profiled separately with call() and merged into the main thread's stats when they are dumped.
+    """
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self._threadStats = None
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.profile.enable()
+
+    def disable(self):
+        self.profile.disable()
+
+    def call(self, func, *args):
+        """
+        Calls func on this (pool) thread with its own profile, merging it into the other threads' stats
+        """
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args)
+        finally:
+            with self._lock:
+                if self._threadStats is None:
+                    self._threadStats = pstats.Stats(profile)
+                else:
+                    self._threadStats.add(profile)
+
+    def dump(self, path):
+        stats = pstats.Stats(self.profile)
+        with self._lock:
+            if self._threadStats is not None:
+                stats.add(self._threadStats)
+        stats.dump_stats(path)
@@ -1,208 +1,863 @@
+import bisect
+import hashlib
+import json
 import logging
 import os.path
-import sqlite3
+import shutil
 import shlex
+import signal
+import stat
+import tempfile
+import threading
 from subprocess import check_call, check_output, CalledProcessError
 import time
-import datetime
+import errno
+import fcntl
 import pwd
+import re
+from operator import itemgetter
+from Records import makeHostRecord
+from Store import openStore
+from Util import writeAtomically
 
 
 class Config:
-    def __init__(self, configPath, databaseFile, hostIdent, nagiosFields):
+    """
+    Keeps the hosts we last wrote config for in the database: type store (sqlite by default, or snapshot), and
+    works out what changed in each newly discovered host list
+    """
+    def __init__(self, configPath, databaseFile, hostIdent, nagiosFields, journalMode=None, synchronous=None,
+                 recordType=None, databaseType='sqlite'):
         self.logger = logging.getLogger(__name__)
         self.configPath = configPath
         self.databaseFile = databaseFile
         self.hostIdent = hostIdent
         self.nagiosFields = nagiosFields
+        # hosts are HostRecords of nagiosFields, stored hosts are read back as recordType
+        self.recordType = recordType or makeHostRecord(nagiosFields, hostIdent)
+        # hosts as stored before the last updateDB, so the writer can find where changed hosts used to be
+        self.previousHosts = None
+        # hosts as stored after the last updateDB, so a long running process doesn't need to reread the database
+        self.currentHosts = None
+        # whether the last updateDB migrated the store to new nagios fields, so every host's config changed
+        self.schemaChanged = False
+        # the store write for the changes found by updateDB, until commitDB
+        self._pendingWrite = None
+        self.store = openStore(databaseType, databaseFile, hostIdent, nagiosFields, recordType=self.recordType,
+                               journalMode=journalMode, synchronous=synchronous)
 
-        # Build create table statement
-        nagiosFieldsStr = ' TEXT, '.join(self.nagiosFields)
-        createTable = "CREATE TABLE nagios_hosts(%s TEXT, PRIMARY KEY (%s))" % (nagiosFieldsStr, self.hostIdent)
+    def updateDB(self, hosts, splitField=None, buckets=None, commit=True):
+        """
+        Takes a list of nagios host records, compares them to the database and updates as required
+        With commit=False the changes are only found, and written to the database by commitDB(), so the caller
+        can write them alongside other work.
+        If buckets is given, only the hosts whose splitField value is in buckets (on either side) are compared,
+        the rest are known to be unchanged.
+        If the store still has the fields of an older mapping, the stored hosts get the fields the mapping added
+        from their discovered hosts, so only real changes are reported, and the store is migrated to the new
+        fields with the discovered hosts in one go.
+        """
+        self.schemaChanged = self.store.pendingMigration is not None
+        if self.schemaChanged:
+            buckets = None
+        diffHosts = hosts
+        if buckets is not None:
+            getSplit = self.recordType.getter(splitField)
+            diffHosts = [host for host in hosts if getSplit(host) in buckets]
+        if self.currentHosts is None:
+            self.previousHosts = self.getStoredHosts(splitField if buckets is not None else None, buckets)
+        elif buckets is not None:
+            self.previousHosts = [host for host in self.currentHosts if getSplit(host) in buckets]
+        else:
+            self.previousHosts = self.currentHosts
+        if self.schemaChanged:
+            self.previousHosts = self._backfill(self.previousHosts, hosts, self.store.pendingMigration[0])
+        changeList, added, updated, removed = self.diffHosts(self.previousHosts, diffHosts)
+        if self.schemaChanged:
+            self._pendingWrite = (self.store.replace, (hosts,))
+        else:
+            self._pendingWrite = (self.applyChanges, (added, updated, removed))
+        if commit:
+            self.commitDB()
+        self.currentHosts = list(hosts)
 
-        if not os.path.exists(self.databaseFile):
-            self.logger.warning('SQLite database does not exist, creating new one.')
+        self.logger.debug("Change list: %s" % (changeList))
+        return changeList
 
-        # Connect to sqlite database and create nagios_hosts table if it doesn't exist
+    def commitDB(self):
+        """
+        Writes the changes found by the last updateDB(commit=False) to the database, raising the store's error if
+        that fails
+        """
+        if self._pendingWrite is None:
+            return
+        write, args = self._pendingWrite
+        self._pendingWrite = None
         try:
-            self.dbconn = sqlite3.connect(databaseFile)
-            self.cur = self.dbconn.cursor()
-            # check this database was created with the same host fields as we have now, otherwise it needs to be deleted
-            self.cur.execute('SELECT sql FROM sqlite_master WHERE type=\'table\' AND name = \'nagios_hosts\';')
-            row = self.cur.fetchone()
-            # self.cur.execute('SELECT name FROM sqlite_master WHERE type=\'table\' AND name=\'nagios_hosts\';')
-            if not row:
-                self.logger.debug('No table called nagios_hosts found. Creating...')
-                self.cur.execute(createTable)
-            else:
-                extraField = False
-                cols = str(row[0][row[0].find('('):].strip('()')).split(',')
-                checkFields = nagiosFields[:]
-                for col in cols:
-                    if col.strip().startswith('PRIMARY'):
-                        continue
-                    fieldName = col.strip().split(' ')[0]
-                    if fieldName not in checkFields:
-                        extraField = True
-                        break
-                    checkFields.remove(fieldName)
-                if len(checkFields) > 0 or extraField:
-                    # nagios fields have changed since database creation
-                    self.logger.critical('Fields in database do not match yaml file. Delete database if you are sure yaml is correct')
-                    self.logger.critical("Current database table create statement: %s" % (row[0]))
-                    self.logger.critical("New database table create statement: %s" % (createTable))
-                    exit(1)
-
-        except sqlite3.Error as e:
-            self.logger.critical("Something bad happened trying to use the SQLite database, error: %s" % e.args[0])
-            self.dbconn.close()
-            exit(1)
-
-    def updateDB(self, hosts):
-        """
-        Takes a dict of nagios hosts, compares them to the database and updates as required
+            write(*args)
+        except Exception:
+            # the database doesn't have the discovered hosts after all, so diff against what it does have next time
+            self.currentHosts = None
+            raise
+
+    def _backfill(self, storedHosts, hosts, addedFields):
+        """
+        Returns storedHosts with the addedFields (blank in the store) filled in from the matching discovered hosts
+        """
+        getIdent = self.recordType.getter(self.hostIdent)
+        discovered = dict((getIdent(host), host) for host in hosts)
+        indexes = [self.recordType.INDEX[field] for field in addedFields]
+        backfilled = []
+        for host in storedHosts:
+            nhost = discovered.get(getIdent(host))
+            if nhost is not None and indexes:
+                values = list(host)
+                for index in indexes:
+                    values[index] = nhost[index]
+                host = self.recordType(values)
+            backfilled.append(host)
+        self.logger.info("Filled in %s for %d stored hosts" % (', '.join(addedFields) or 'no new fields',
+                                                             len(backfilled)))
+        return backfilled
+
+    def diffHosts(self, currentHosts, hosts):
+        """
+        Compares the hosts currently stored against newly discovered hosts, using dicts keyed by
+        hostIdent so the comparison is linear in the number of hosts.
+        Returns the change list (hostIdent -> added / removed / updated:field:field) along with
+        the lists of added, updated and removed host records.
         """
         changeList = {}
-        currentHosts = self.getSQLHosts()
-        currentHosts2 = currentHosts[:]
+        added = []
+        updated = []
+        getIdent = self.recordType.getter(self.hostIdent)
+        currentIndex = dict((getIdent(chost), chost) for chost in currentHosts)
+        seen = set()
 
         for nhost in hosts:
-            exists = False
-            for chost in currentHosts:
-                if nhost[self.hostIdent] == chost[self.hostIdent]:
-                    currentHosts2.remove(chost)
-                    exists = True
-                    different = []
-                    # nhost already exists in database
-                    for attrib in nhost:
-                        if attrib == self.hostIdent:
-                            continue
-                        if not nhost[attrib] == chost[attrib]:
-                            different.append(attrib)
-                    if len(different) > 0:
-                        self.updateHostinDB(nhost)
-                        changeList[chost[self.hostIdent]] = "updated:%s" % (':'.join(different))
-            if not exists:
+            ident = getIdent(nhost)
+            seen.add(ident)
+            chost = currentIndex.get(ident)
+            if chost is None:
                 # nhost doesnt exist in currentHosts
-                self.addHosttoDB(nhost)
-                changeList[nhost[self.hostIdent]] = 'added'
-        if len(currentHosts2) > 0:
-            for host in currentHosts2:
-                self.deleteHostinDB(host)
-                changeList[host[self.hostIdent]] = 'removed'
+                added.append(nhost)
+                changeList[ident] = 'added'
+                continue
+            # nhost already exists in database, only look at its fields if the records differ
+            if nhost != chost:
+                updated.append(nhost)
+                changeList[ident] = "updated:%s" % (':'.join(nhost.diff(chost)))
 
-        self.logger.debug("Change list: %s" % (changeList))
-        return changeList
+        removed = [chost for ident, chost in currentIndex.items() if ident not in seen]
+        for chost in removed:
+            changeList[getIdent(chost)] = 'removed'
+
+        return changeList, added, updated, removed
+
+    def getStoredHosts(self, whereField=None, whereValues=None):
+        """
+        Returns the stored hosts, or if whereField is given only those whose whereField value is in whereValues
+        """
+        return self.store.load(whereField, whereValues)
+
+    def empty(self):
+        """
+        Returns True if the database has no hosts, as when it has just been created
+        """
+        return self.store.empty()
 
-    def getSQLHosts(self):
-        hosts = []
-        selectStr = "SELECT %s FROM nagios_hosts;" % (','.join(self.nagiosFields))
-        for row in self.dbconn.execute(selectStr):
-            hostHash = {}
-            for x in range(0, len(self.nagiosFields)):
-                hostHash[self.nagiosFields[x]] = str(row[x])
-            hosts.append(hostHash)
-        return hosts
+    def applyChanges(self, added, updated, removed):
+        """
+        Writes the added, updated and removed hosts from a diff to the store in one go
+        """
+        self.store.applyChanges(added, updated, removed)
 
     def addHosttoDB(self, host):
-        cols = []
-        values = []
-        for field in host:
-            cols.append(field)
-            values.append('"' + host[field] + '"')
-        insertSQL = "INSERT INTO nagios_hosts(%s) VALUES(%s);" % (', '.join(cols), ', '.join(values))
-        self.logger.debug("Adding a host to DB: %s" % insertSQL)
-        self.dbconn.execute(insertSQL)
-        self.dbconn.commit()
+        self.logger.debug("Adding a host to DB: %s" % host.ident())
+        self.applyChanges([host], [], [])
 
     def updateHostinDB(self, host):
-        values = []
-        for field in host:
-            values.append(field + '="' + host[field] + '"')
-
-        updateSQL = "UPDATE nagios_hosts SET %s WHERE %s;" % (', '.join(values), self.hostIdent + '="' + host[self.hostIdent] + '"')
-        self.logger.debug("Updating a host in DB: %s" % updateSQL)
-        self.dbconn.execute(updateSQL)
-        self.dbconn.commit()
+        self.logger.debug("Updating a host in DB: %s" % host.ident())
+        self.applyChanges([], [host], [])
 
     def deleteHostinDB(self, host):
-        deleteSQL = "DELETE FROM nagios_hosts WHERE %s;" % (self.hostIdent + '="' + host[self.hostIdent] + '"')
-        self.logger.debug("Deleting a host from DB: %s" % deleteSQL)
-        self.dbconn.execute(deleteSQL)
-        self.dbconn.commit()
+        self.logger.debug("Deleting a host from DB: %s" % host.ident())
+        self.applyChanges([], [], [host])
+
+
+class HostDigests:
+    """
+    Content digests of the projected host set, stored in digestFile next to the database. Hosts are hashed in
+    hostIdent order, one digest per splitBy bucket, and the fleet digest covers all the bucket digests (and the
+    nagios fields, so changing the mappings changes it). If the fleet digest matches the stored one nothing has
+    changed since the database was last updated; otherwise only the buckets whose digests differ need diffing.
+    The stored digests only describe the database they were saved with, so they mean nothing to an empty one.
+    """
+    def __init__(self, digestFile, hostIdent, nagiosFields, splitBy):
+        self.logger = logging.getLogger(__name__)
+        self.digestFile = digestFile
+        self.hostIdent = hostIdent
+        self.nagiosFields = nagiosFields
+        self.splitBy = splitBy
+        self._getIdent = itemgetter(nagiosFields.index(hostIdent))
+        if splitBy.lower() != 'none':
+            self._getSplit = itemgetter(nagiosFields.index(splitBy))
+        self.fleet = None
+        self.buckets = {}
+        self.stored = {'fleet': None, 'buckets': {}}
+        if os.path.isfile(self.digestFile):
+            try:
+                with open(self.digestFile) as f:
+                    self.stored = json.load(f)
+            except ValueError:
+                self.logger.warning("Ignoring unreadable host digest file %s" % (self.digestFile))
+
+    def compute(self, hosts):
+        """
+        Takes the discovered host records, whose values are in nagiosFields order
+        """
+        hashers = {}
+        for host in sorted(hosts, key=self._getIdent):
+            bucket = self._getBucket(host)
+            if bucket not in hashers:
+                hashers[bucket] = hashlib.sha1()
+            hashers[bucket].update('\0'.join(host) + '\n')
+        self.buckets = dict((bucket, hashers[bucket].hexdigest()) for bucket in hashers)
+
+        fleet = hashlib.sha1('\0'.join(self.nagiosFields) + '\n')
+        for bucket in sorted(self.buckets):
+            fleet.update("%s\0%s\n" % (bucket, self.buckets[bucket]))
+        self.fleet = fleet.hexdigest()
+        return self.fleet
+
+    def unchanged(self):
+        return self.fleet is not None and self.fleet == self.stored['fleet']
+
+    def changedBuckets(self):
+        """
+        Returns the buckets whose hosts have changed, or None if every host needs comparing
+        """
+        if self.splitBy.lower() == 'none' or self.stored['fleet'] is None:
+            return None
+        storedBuckets = self.stored['buckets']
+        return set([bucket for bucket in set(self.buckets) | set(storedBuckets)
+                    if self.buckets.get(bucket) != storedBuckets.get(bucket)])
+
+    def save(self):
+        self.stored = {'fleet': self.fleet, 'buckets': self.buckets}
+        writeAtomically(self.digestFile, json.dumps(self.stored))
+
+    def _getBucket(self, host):
+        if self.splitBy.lower() == 'none':
+            return ''
+        return self._getSplit(host)
 
 
 class Writer:
-    def __init__(self, configDir, hosts, changedHosts, splitBy):
+    def __init__(self, configDir, hosts, changedHosts, splitBy, hostIdent=None, previousHosts=None, incremental=False,
+                 nagiosFields=None):
+        """
+        Writes nagios host config for hosts, one file per separate_hosts_by bucket. hosts are host records whose
+        values are in nagiosFields order (nagiosFields defaults to the first host's fields).
+        In incremental mode (which needs hostIdent and the previously stored hosts to find the buckets removed and
+        moved hosts were in) only the buckets holding a changed host are rewritten, buckets that became empty are removed and
+        every other file is left untouched.
+        """
         self.logger = logging.getLogger(__name__)
         self.configDir = configDir
+        self.splitBy = splitBy
+        self.hostIdent = hostIdent
+        self.filesWritten = []
+        self.filesRemoved = []
+        self.bytesWritten = 0
         if not os.path.isdir(self.configDir):
-            self.logger.critical('Nagios configuration path does not exist, exiting.')
-            exit(1)
+            raise OSError(errno.ENOENT, 'Nagios configuration path does not exist', self.configDir)
+        self.fields = nagiosFields or (hosts[0].keys() if hosts else [])
+        self.hostTemplate = self._buildHostTemplate(self.fields)
+        self.fieldTemplates = self._buildFieldTemplates(self.fields)
+        if splitBy.lower() != 'none':
+            self._getSplit = itemgetter(self.fields.index(splitBy))
 
-        # remove all the files in the directory currently
-        filelist = [f for f in os.listdir(self.configDir) if f.endswith(".cfg")]
-        for f in filelist:
-            os.remove(self.configDir + '/' + f)
+        newFiles = {}
+        for host in hosts:
+            newFiles.setdefault(self._getFileName(host), []).append(host)
+        self.logger.debug("new files: %s" % (newFiles.keys()))
 
-        if splitBy.lower() == 'none':
-            newFiles = ['cloudgazer.cfg']
+        currentFiles = [f for f in os.listdir(self.configDir) if f.endswith(".cfg")]
+        if incremental and hostIdent and previousHosts is not None:
+            rewriteFiles = self._getAffectedFiles(newFiles, currentFiles, changedHosts, previousHosts)
+            removeFiles = [f for f in currentFiles if f not in newFiles]
         else:
-            newFiles = {}
-            for host in hosts:
-                filename = "cloudgazer_%s.cfg" % (host[splitBy])
-                if filename not in newFiles:
-                    newFiles[filename] = self._convertHostToStr(host)
-                else:
-                    newFiles[filename] += self._convertHostToStr(host)
-        self.logger.debug("new files: %s" % (newFiles))
+            rewriteFiles = newFiles.keys()
+            removeFiles = currentFiles
 
-        for file in newFiles:
+        # remove the files we no longer need (all of them for a full rewrite)
+        for f in removeFiles:
+            os.remove(os.path.join(self.configDir, f))
+            self.filesRemoved.append(f)
+
+        for file in rewriteFiles:
             new_host_cfg_path = os.path.join(self.configDir, file)
+            content = self._renderHosts(newFiles[file])
+            # Check to see if we have a file called foo.cfg.services.
+            # if so, nclude it in our host file generation to get around
+            # an issue we're seeing with empty ASGs causing Nagios Config
+            # errors due to services being defined for hosts that don't
+            # exist anymore.
+            servicesPath = new_host_cfg_path + '.services'
+            if not os.path.isfile(servicesPath):
+                servicesPath = None
+            if file in currentFiles and file not in removeFiles and \
+                    self._sameContent(new_host_cfg_path, content, servicesPath):
+                continue
             with open(new_host_cfg_path, 'w') as f:
-                f.write(newFiles[file])
-                # Check to see if we have a file called foo.cfg.services.
-                # if so, nclude it in our host file generation to get around
-                # an issue we're seeing with empty ASGs causing Nagios Config
-                # errors due to services being defined for hosts that don't
-                # exist anymore.
-                if os.path.isfile(new_host_cfg_path + '.services'):
-                    with open(new_host_cfg_path + '.services') as svc_file:
-                        for l in svc_file:
-                            f.write(l)
-
-    def _convertHostToStr(self, host):
-        hostStr = 'define host {\n'
-        longestField = 0
-        for field in host:
-            if len(field) > longestField:
-                longestField = len(field)
-        for field in host:
-            tabStr = '' + '\t' * ((longestField / 4) - (len(field) / 4))
-            hostStr += "\t%s\t\t%s%s\n" % (field, tabStr, host[field])
-        hostStr += '}\n\n'
-        return hostStr
-
-    def _getFileName(self, host, splitBy):
-        if splitBy.lower() == 'none':
+                f.write(content)
+                if servicesPath:
+                    with open(servicesPath) as svc_file:
+                        shutil.copyfileobj(svc_file, f)
+                self.bytesWritten += f.tell()
+            self.filesWritten.append(file)
+        self.logger.debug("files written: %s, files removed: %s" % (self.filesWritten, self.filesRemoved))
+
+    def _getAffectedFiles(self, newFiles, currentFiles, changedHosts, previousHosts):
+        """
+        Returns the bucket files that hold a changed host, either now or before this run, along with any bucket
+        files that are missing on disk or whose .services companion has changed since they were written.
+        """
+        affected = set()
+        getIdent = itemgetter(self.fields.index(self.hostIdent))
+        for hosts in (newFiles.values() + [previousHosts]):
+            for host in hosts:
+                if getIdent(host) in changedHosts:
+                    affected.add(self._getFileName(host))
+        for file in newFiles:
+            path = os.path.join(self.configDir, file)
+            if file not in currentFiles:
+                affected.add(file)
+            elif os.path.isfile(path + '.services') and os.path.getmtime(path + '.services') > os.path.getmtime(path):
+                affected.add(file)
+        return [file for file in affected if file in newFiles]
+
+    def _buildHostTemplate(self, fields):
+        """
+        Builds the define host block for fields once, padding the field names out to line the values up, as a
+        format string that only needs the values filled in.
+        """
+        return 'define host {\n' + ''.join(self._buildFieldTemplates(fields)) + '}\n\n'
+
+    def _buildFieldTemplates(self, fields):
+        # one directive line per field, each needing its value filled in
+        longestField = max([len(field) for field in fields] or [0])
+        return ["\t%s\t\t%s%%s\n" % (field.replace('%', '%%'), '\t' * ((longestField / 4) - (len(field) / 4)))
+                for field in fields]
+
+    def _renderHosts(self, hosts):
+        # a host record is already the tuple of values the template needs, unless it has an empty value, as nagios
+        # rejects a directive with no value, so those are left out
+        template = self.hostTemplate
+        return ''.join([template % host if '' not in host else self._renderSparseHost(host) for host in hosts])
+
+    def _renderSparseHost(self, host):
+        directives = [fieldTemplate % value for fieldTemplate, value in zip(self.fieldTemplates, host) if value != '']
+        return 'define host {\n' + ''.join(directives) + '}\n\n'
+
+    def _sameContent(self, path, content, servicesPath):
+        # compares a file on disk with the rendered hosts followed by the .services companion, if any
+        if os.path.getsize(path) != len(content) + (os.path.getsize(servicesPath) if servicesPath else 0):
+            return False
+        with open(path) as f:
+            if f.read(len(content)) != content:
+                return False
+            if servicesPath:
+                with open(servicesPath) as svc_file:
+                    while True:
+                        chunk = svc_file.read(65536)
+                        if f.read(len(chunk)) != chunk:
+                            return False
+                        if not chunk:
+                            break
+        return True
+
+    def _getFileName(self, host):
+        if self.splitBy.lower() == 'none':
             return 'cloudgazer.cfg'
         else:
-            return "cloudgazer_%s.cfg" % (host[splitBy])
+            return "cloudgazer_%s.cfg" % (self._getSplit(host))
+
+
+class StagedConfig:
+    """
+    Stages nagios host config in a new generation directory next to host_dir. host_dir is a symlink to the live
+    generation, and publishing swaps it over to the staged one with an atomic rename, so nagios never sees a
+    partially written config. The previous generation is kept so it can be rolled back to instantly.
+    """
+    def __init__(self, hostDir):
+        self.logger = logging.getLogger(__name__)
+        self.hostDir = hostDir.rstrip('/')
+        parentDir, baseName = os.path.split(self.hostDir)
+        # hidden, so a cfg_dir that includes the parent directory won't pick up the other generations
+        self.generationsDir = os.path.join(parentDir, '.%s.generations' % (baseName))
+        self.previousLink = os.path.join(self.generationsDir, 'previous')
+        if not os.path.isdir(self.generationsDir):
+            os.makedirs(self.generationsDir)
+        self._adoptHostDir()
+
+        # start the new generation from the live files, so incremental writes only touch what changed
+        self.path = tempfile.mkdtemp(prefix='gen-', dir=self.generationsDir)
+        os.chmod(self.path, stat.S_IMODE(os.stat(self.hostDir).st_mode))
+        for f in os.listdir(self.hostDir):
+            if os.path.isfile(os.path.join(self.hostDir, f)):
+                shutil.copy2(os.path.join(self.hostDir, f), os.path.join(self.path, f))
+        self.logger.debug("Staging nagios config in %s" % (self.path))
+
+    def publish(self):
+        """
+        Flushes the staged generation to disk and swaps host_dir over to it, keeping the old one as previous
+        """
+        self._sync()
+        previous = os.path.realpath(self.hostDir)
+        self._swapLink(self.hostDir, self.path)
+        self._swapLink(self.previousLink, previous)
+        self.logger.debug("Published nagios config generation %s, previous was %s" % (self.path, previous))
+        self._prune()
+
+    def rollback(self):
+        """
+        Swaps host_dir back to the previous generation and removes the one we published
+        """
+        if not os.path.islink(self.previousLink):
+            self.logger.critical('No previous nagios config generation to roll back to')
+            return False
+        self._swapLink(self.hostDir, os.path.realpath(self.previousLink))
+        self.logger.warning("Rolled nagios config back to %s" % (os.path.realpath(self.previousLink)))
+        self.discard()
+        return True
+
+    def discard(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def _adoptHostDir(self):
+        # the first time we run, move a plain host_dir into the generations directory and link to it
+        if os.path.islink(self.hostDir):
+            return
+        if not os.path.isdir(self.hostDir):
+            raise OSError(errno.ENOENT, 'Nagios configuration path does not exist', self.hostDir)
+        initial = tempfile.mkdtemp(prefix='gen-', dir=self.generationsDir)
+        os.rmdir(initial)
+        self.logger.warning("Moving %s to %s and replacing it with a symlink" % (self.hostDir, initial))
+        os.rename(self.hostDir, initial)
+        self._swapLink(self.hostDir, initial)
+
+    def _swapLink(self, link, target):
+        tmpLink = "%s.tmp-%d" % (link, os.getpid())
+        if os.path.lexists(tmpLink):
+            os.remove(tmpLink)
+        os.symlink(os.path.relpath(target, os.path.dirname(link)), tmpLink)
+        os.rename(tmpLink, link)
+        self._fsyncPath(os.path.dirname(link))
+
+    def _sync(self):
+        for f in os.listdir(self.path):
+            fd = os.open(os.path.join(self.path, f), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self._fsyncPath(self.path)
+
+    def _fsyncPath(self, path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _prune(self):
+        keep = [os.path.realpath(self.hostDir), os.path.realpath(self.previousLink)]
+        for f in os.listdir(self.generationsDir):
+            path = os.path.join(self.generationsDir, f)
+            if f.startswith('gen-') and os.path.isdir(path) and path not in keep:
+                self.logger.debug("Removing old nagios config generation %s" % (path))
+                shutil.rmtree(path, ignore_errors=True)
+
+
+class RestartScheduler:
+    """
+    Debounces nagios verify/restart cycles. Change sets from consecutive runs are merged and held until no new
+    changes have arrived for quietPeriod seconds and at least minInterval seconds have passed since the last
+    restart, but never for more than maxDeferral seconds after the first held change (0 for no limit). With all
+    three at 0 every change is due straight away.
+    Along with the merged changedHosts it keeps each changed host's record from before its first held change, so
+    the writer can still find where that host used to be. State is kept in stateFile, so it carries over between
+    cron runs as well as daemon polls. The previous hosts are handed back as recordType records.
+    Changes that were taken but failed to publish are held again with retry(), along with the targets they
+    failed on, whose next write must be a full one as their live config is behind the database.
+    Taken changes are kept in stateFile as in flight until published(), as the database already has them, so if
+    the process dies before then nothing else would bring them back. requeue() holds them again.
+    """
+    def __init__(self, stateFile, hostIdent, quietPeriod=0, minInterval=0, maxDeferral=0, recordType=None):
+        self.logger = logging.getLogger(__name__)
+        self.stateFile = stateFile
+        self.hostIdent = hostIdent
+        self.recordType = recordType
+        self.quietPeriod = quietPeriod
+        self.minInterval = minInterval
+        self.maxDeferral = maxDeferral
+        self.state = {'changedHosts': {}, 'previousHosts': {}, 'firstChange': None, 'lastChange': None,
+                      'lastRestart': None, 'retryTargets': [], 'inFlight': None}
+        if os.path.isfile(self.stateFile):
+            try:
+                with open(self.stateFile) as f:
+                    self.state.update(json.load(f))
+            except ValueError:
+                self.logger.warning("Ignoring unreadable restart state file %s" % (self.stateFile))
+
+    def add(self, changedHosts, previousHosts, now=None):
+        """
+        Merges a change set, and the hosts as they were before it, into the held changes
+        """
+        if not changedHosts:
+            return
+        now = now or time.time()
+        pending = self.state['changedHosts']
+        previousIndex = dict((host.ident(), host) for host in previousHosts or [])
+        for ident, change in changedHosts.items():
+            if ident not in pending and ident in previousIndex:
+                self.state['previousHosts'][ident] = previousIndex[ident].asDict()
+            merged = self.mergeChange(pending.get(ident), change)
+            if merged:
+                pending[ident] = merged
+            else:
+                pending.pop(ident, None)
+                self.state['previousHosts'].pop(ident, None)
+        if self.state['firstChange'] is None:
+            self.state['firstChange'] = now
+        self.state['lastChange'] = now
+        if not pending:
+            self.state['firstChange'] = None
+        self._save()
+
+    def due(self, now=None):
+        """
+        Returns True if the held changes should be verified and nagios restarted now
+        """
+        if not self.state['changedHosts']:
+            return False
+        now = now or time.time()
+        if self.maxDeferral and now - self.state['firstChange'] >= self.maxDeferral:
+            return True
+        quiet = now - self.state['lastChange'] >= self.quietPeriod
+        rested = self.state['lastRestart'] is None or now - self.state['lastRestart'] >= self.minInterval
+        return quiet and rested
+
+    def pending(self):
+        return len(self.state['changedHosts']) > 0
+
+    def retry(self, changedHosts, previousHosts, targets):
+        """
+        Holds taken changes that didn't get published again, and marks targets (names, '' when not sharded) as
+        needing a full write
+        """
+        self.state['retryTargets'] = sorted(set(self.state['retryTargets']) | set(targets))
+        self._save()
+        self.add(changedHosts, previousHosts)
+
+    def retryTargets(self):
+        return list(self.state['retryTargets'])
+
+    def published(self, targets):
+        """
+        Records that the taken changes have been dealt with (any that failed held again by retry() first), and
+        that targets have had their config published and nagios restarted
+        """
+        if self.state['inFlight'] is not None or set(targets) & set(self.state['retryTargets']):
+            self.state['retryTargets'] = [target for target in self.state['retryTargets'] if target not in targets]
+            self.state['inFlight'] = None
+            self._save()
+
+    def take(self, now=None):
+        """
+        Returns the merged changedHosts and the previous host records, and clears them, recording a restart now.
+        They are kept as in flight until published().
+        """
+        changedHosts = self.state['changedHosts']
+        previousHosts = self.state['previousHosts'].values()
+        if self.recordType:
+            previousHosts = [self.recordType.fromDict(host) for host in previousHosts]
+        self.state['inFlight'] = dict((key, self.state[key]) for key in ('changedHosts', 'previousHosts',
+                                                                         'firstChange', 'lastChange', 'lastRestart'))
+        self.state.update({'changedHosts': {}, 'previousHosts': {}, 'firstChange': None, 'lastChange': None,
+                           'lastRestart': now or time.time()})
+        self._save()
+        return changedHosts, previousHosts
+
+    def requeue(self):
+        """
+        Holds the changes taken by a run that never got to published() again, ahead of any held since, as if
+        they had never been taken
+        """
+        inFlight = self.state['inFlight']
+        if inFlight is None:
+            return
+        self.logger.warning("Holding %d host changes again, the run that took them did not finish publishing them" %
+                            (len(inFlight['changedHosts'])))
+        pending = dict(inFlight['changedHosts'])
+        previousHosts = dict(inFlight['previousHosts'])
+        for ident, change in self.state['changedHosts'].items():
+            if ident not in pending and ident in self.state['previousHosts']:
+                previousHosts[ident] = self.state['previousHosts'][ident]
+            merged = self.mergeChange(pending.get(ident), change)
+            if merged:
+                pending[ident] = merged
+            else:
+                pending.pop(ident, None)
+                previousHosts.pop(ident, None)
+        self.state.update({'changedHosts': pending, 'previousHosts': previousHosts,
+                           'firstChange': inFlight['firstChange'] if pending else None,
+                           'lastChange': max(inFlight['lastChange'], self.state['lastChange']) if pending else None,
+                           'lastRestart': inFlight['lastRestart'], 'inFlight': None})
+        self._save()
+
+    @staticmethod
+    def mergeChange(held, change):
+        """
+        Returns the combined change for a host that changed again before its last change was acted on (held is
+        None if it hadn't), or None if the changes cancel out
+        """
+        if held is None:
+            return change
+        if held == 'added':
+            return None if change == 'removed' else 'added'
+        if held == 'removed':
+            # removed and back again before nagios saw either, most likely a new instance reusing the identifier
+            return change
+        if change.startswith('updated'):
+            fields = held.split(':')[1:]
+            fields += [field for field in change.split(':')[1:] if field not in fields]
+            return ':'.join(['updated'] + fields)
+        return change
+
+    def _save(self):
+        writeAtomically(self.stateFile, json.dumps(self.state))
+
+
+class ShardRing:
+    """
+    Assigns hosts to shard targets (nagios/icinga nodes) by consistent hashing of a host field, the host identifier
+    unless splitBy is given, so adding or removing a target only moves the hosts that hash to it. Each target gets
+    replicas points on the ring times its weight (default 1). A target may also list field values that are always
+    assigned to it.
+    """
+    def __init__(self, targets, hostIdent, splitBy=None, replicas=100):
+        self.targets = targets
+        self.field = splitBy or hostIdent
+        self.replicas = replicas
+        self.pinned = {}
+        points = []
+        for name in sorted(targets):
+            for value in targets[name].get('values') or []:
+                self.pinned[str(value)] = name
+            for i in range(int(replicas * targets[name].get('weight', 1))):
+                points.append((self._hash("%s-%d" % (name, i)), name))
+        points.sort()
+        self.points = [point for point, name in points]
+        self.names = [name for point, name in points]
+
+    def getTarget(self, host):
+        return self._assign(host.get(self.field))
+
+    def split(self, hosts):
+        """
+        Returns {target name: [hosts assigned to it]}, with every target present
+        """
+        shards = dict((name, []) for name in self.targets)
+        if hosts:
+            getField = hosts[0].getter(self.field)
+            for host in hosts:
+                shards[self._assign(getField(host))].append(host)
+        return shards
+
+    def signature(self):
+        """
+        Identifies the layout, it changes whenever hosts could be assigned differently
+        """
+        layout = [self.field, self.replicas] + [(name, self.targets[name].get('weight', 1),
+                                                 sorted([str(value) for value in self.targets[name].get('values') or []]))
+                                                for name in sorted(self.targets)]
+        return hashlib.sha1(json.dumps(layout)).hexdigest()
+
+    def _assign(self, value):
+        if value in self.pinned:
+            return self.pinned[value]
+        return self.names[bisect.bisect(self.points, self._hash(value)) % len(self.points)]
+
+    def _hash(self, key):
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+
+class Validator:
+    """
+    Checks rendered host config for the mistakes that most often fail test_config_cmd, without starting nagios:
+    duplicate host_names, directives with no value, and (when the known templates are given) templates in use
+    that don't exist. .cfg.services companions whose .cfg is gone are only warned about, as their services are no
+    longer loaded, which is expected once a bucket has no hosts.
+    """
+    MAX_PROBLEMS = 20
+    HOST_BLOCK = re.compile(r'^[ \t]*define[ \t]+host[ \t]*\{([^}]*)\}', re.M)
+    # name and value of each directive (each on its own line), leaving out comments
+    DIRECTIVE = re.compile(r'\n[ \t]*([^\s;#}]+)[ \t]*([^\n;]*)')
+
+    def __init__(self, templates=None):
+        self.logger = logging.getLogger(__name__)
+        self.templates = set(templates) if templates is not None else None
+
+    def check(self, files):
+        """
+        Takes the files of a host config tree (name -> content) and returns the problems found
+        """
+        problems = []
+        hostFiles = {}
+        for name in sorted(files):
+            if name.endswith('.cfg.services') and name[:-len('.services')] not in files:
+                self.logger.warning("%s has no %s, so its services are not loaded" % (name, name[:-len('.services')]))
+            if not name.endswith('.cfg'):
+                continue
+            for block in self.HOST_BLOCK.finditer(files[name]):
+                directives = self.DIRECTIVE.findall(block.group(1))
+                host = dict(directives)
+                hostName = host.get('host_name', '').strip()
+                if not hostName:
+                    problems.append("Host with no host_name in %s" % (name))
+                    continue
+                if hostName in hostFiles:
+                    problems.append("Duplicate host_name %s in %s and %s" % (hostName, hostFiles[hostName], name))
+                hostFiles[hostName] = name
+                for field, value in directives:
+                    if not value.strip():
+                        problems.append("Empty %s for host %s in %s" % (field, hostName, name))
+                use = host.get('use', '').strip()
+                if self.templates is not None and use and use not in self.templates:
+                    for template in use.split(','):
+                        if template.strip() not in self.templates:
+                            problems.append("Unknown template %s for host %s in %s" % (template.strip(), hostName, name))
+        if len(problems) > self.MAX_PROBLEMS:
+            problems = problems[:self.MAX_PROBLEMS] + ["and %d more problems" % (len(problems) - self.MAX_PROBLEMS)]
+        return problems
+
+
+class VerifyCache:
+    """
+    Remembers the content hashes of host config trees that passed test_config_cmd in cacheFile, so an identical
+    tree doesn't need verifying again. Entries expire after ttl seconds, as the rest of the nagios config they
+    were verified against may have changed since.
+    """
+    def __init__(self, cacheFile, ttl=86400, maxEntries=50):
+        self.logger = logging.getLogger(__name__)
+        self.cacheFile = cacheFile
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        # targets are verified in parallel
+        self._lock = threading.Lock()
+        try:
+            with open(self.cacheFile) as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            self.entries = {}
+
+    @staticmethod
+    def key(files, nagiosConfig):
+        """
+        Hashes the .cfg files nagios reads from a host config tree, along with the target and its test_config_cmd
+        """
+        digest = hashlib.sha1("%s\0%s\n" % (nagiosConfig['host_dir'], nagiosConfig['test_config_cmd']))
+        for name in sorted(files):
+            if name.endswith('.cfg'):
+                digest.update("%s\0%d\n" % (name, len(files[name])))
+                digest.update(files[name])
+        return digest.hexdigest()
+
+    def verified(self, key):
+        with self._lock:
+            verifiedAt = self.entries.get(key)
+            return verifiedAt is not None and time.time() - verifiedAt < self.ttl
+
+    def add(self, key):
+        with self._lock:
+            now = time.time()
+            self.entries[key] = now
+            entries = sorted([(verifiedAt, k) for k, verifiedAt in self.entries.items() if now - verifiedAt < self.ttl])
+            self.entries = dict((k, verifiedAt) for verifiedAt, k in entries[-self.maxEntries:])
+            try:
+                writeAtomically(self.cacheFile, json.dumps(self.entries))
+            except (IOError, OSError) as e:
+                self.logger.warning("Unable to save verify cache %s: %s" % (self.cacheFile, e))
+
+
+def readConfigTree(configDir):
+    """
+    Returns the files of a host config directory, name -> content
+    """
+    files = {}
+    for name in os.listdir(configDir):
+        path = os.path.join(configDir, name)
+        if os.path.isfile(path):
+            with open(path) as f:
+                files[name] = f.read()
+    return files
 
 
 class Manager:
     """
     Looks after verifying config and restarting Nagios
     """
-    def __init__(self, config):
+    def __init__(self, config, validator=None, verifyCache=None):
         self.logger = logging.getLogger(__name__)
         self.config = config
+        self.validator = validator
+        self.verifyCache = verifyCache
+
+    def verifyConfig(self, configDir=None):
+        """
+        Runs test_config_cmd. A {host_dir} placeholder in the command is replaced with configDir, or host_dir
+        With a validator the host config is checked first, and test_config_cmd isn't run if that finds problems.
+        With a verifyCache a tree identical to one that has already passed isn't verified again.
+        """
+        if configDir is None:
+            configDir = os.path.expanduser(self.config['host_dir'])
+        status, cacheKey = self._precheck(configDir)
+        if status is None:
+            status = self._runTest(configDir)
+            if status['ok'] and cacheKey:
+                self.verifyCache.add(cacheKey)
+        return status
+
+    def _precheck(self, configDir):
+        """
+        Returns (status, cache key) for a host config tree. status is None unless the tree is already known to
+        pass, or the validator found problems with it.
+        """
+        if self.validator is None and self.verifyCache is None:
+            return None, None
+        files = readConfigTree(configDir)
+        cacheKey = None
+        if self.verifyCache:
+            cacheKey = self.verifyCache.key(files, self.config)
+            if self.verifyCache.verified(cacheKey):
+                self.logger.info('Nagios config is identical to config that already passed, not verifying it again')
+                return {'ok': True, 'output': 'Identical to already verified config', 'cached': True}, cacheKey
+        if self.validator:
+            problems = self.validator.check(files)
+            if problems:
+                self.logger.debug("Nagios config failed validation: %s" % ('; '.join(problems)))
+                return {'ok': False, 'output': '\n'.join(problems)}, cacheKey
+        return None, cacheKey
 
-    def verifyConfig(self):
+    def _runTest(self, configDir):
         status = {}
+        testCmd = self.config['test_config_cmd'].replace('{host_dir}', configDir)
         try:
-            self.logger.debug("Verifying nagios config, running: %s" % (self.config['test_config_cmd']))
-            status['output'] = check_output(shlex.split(self.config['test_config_cmd']))
+            self.logger.debug("Verifying nagios config, running: %s" % (testCmd))
+            status['output'] = check_output(shlex.split(testCmd))
             status['ok'] = True
             return status
         except OSError as e:
@@ -216,7 +871,98 @@ class Manager:
             status['output'] = e.output
             return status
 
+    def verifyAndPublish(self, stage):
+        """
+        Verifies and publishes a StagedConfig. If test_config_cmd can be pointed at the staged tree with
+        {host_dir} it is verified before publishing and discarded on failure, otherwise it is validated (or found in
+        the cache) first, then published, verified in place and rolled back on failure.
+        """
+        if '{host_dir}' in self.config['test_config_cmd']:
+            status = self.verifyConfig(configDir=stage.path)
+            if status['ok']:
+                stage.publish()
+            else:
+                stage.discard()
+        else:
+            # validate (or find in the cache) before publishing, as only test_config_cmd needs the live tree
+            status, cacheKey = self._precheck(stage.path)
+            if status is not None and not status['ok']:
+                stage.discard()
+                return status
+            stage.publish()
+            if status is None:
+                status = self._runTest(os.path.expanduser(self.config['host_dir']))
+                if not status['ok']:
+                    stage.rollback()
+                elif cacheKey:
+                    self.verifyCache.add(cacheKey)
+        return status
+
     def restart(self):
+        """
+        Restarts nagios. With restart_strategy: reload, nagios is first asked to reload its config in place (keeping
+        the process and its retention state), and restart_cmd is only run if that doesn't complete.
+        """
+        if self.config.get('restart_strategy', 'restart') == 'reload':
+            if self.reload():
+                return True
+            self.logger.warning('Nagios reload did not complete, falling back to restart_cmd')
+        return self.restartProcess()
+
+    def reload(self):
+        """
+        Sends a RESTART_PROGRAM external command through command_file (or with reload_via: signal, a SIGHUP to the
+        pid in pid_file) and waits up to reload_timeout seconds for program_start in status_file to change.
+        Returns True once nagios has reloaded.
+        """
+        statusFile = self.config.get('status_file')
+        if not statusFile:
+            self.logger.warning('Nagios reload needs status_file set to confirm the reload')
+            return False
+        statusFile = os.path.expanduser(statusFile)
+        timeout = self.config.get('reload_timeout', 60)
+        programStart = self._getProgramStart(statusFile)
+
+        try:
+            if self.config.get('reload_via', 'command_file') == 'signal':
+                with open(os.path.expanduser(self.config['pid_file'])) as f:
+                    pid = int(f.read().strip())
+                self.logger.debug("Reloading nagios by sending SIGHUP to pid %d" % (pid))
+                os.kill(pid, signal.SIGHUP)
+            else:
+                self.logger.debug("Reloading nagios through command file %s" % (self.config['command_file']))
+                # non blocking, so we fail straight away rather than hang if nothing is reading the pipe
+                fd = os.open(self.config['command_file'], os.O_WRONLY | os.O_NONBLOCK)
+                try:
+                    os.write(fd, "[%d] RESTART_PROGRAM\n" % (time.time()))
+                finally:
+                    os.close(fd)
+        except (OSError, IOError, ValueError, KeyError) as e:
+            self.logger.debug("Nagios reload failed to send: %s" % (e))
+            return False
+
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            time.sleep(1)
+            newProgramStart = self._getProgramStart(statusFile)
+            if newProgramStart is not None and newProgramStart != programStart:
+                self.logger.debug('Nagios reloaded')
+                return True
+        self.logger.debug("Nagios did not reload within %d seconds" % (timeout))
+        return False
+
+    def _getProgramStart(self, statusFile):
+        # program_start in the programstatus block of status.dat changes whenever nagios (re)starts
+        try:
+            with open(statusFile) as f:
+                for line in f:
+                    if line.strip().startswith('program_start='):
+                        return line.strip().split('=', 1)[1]
+        except IOError:
+            pass
+        return None
+
+    def restartProcess(self):
         try:
             self.logger.debug("Restarting nagios with command: %s" % (self.config['restart_cmd']))
             check_call(shlex.split(self.config['restart_cmd']))
@@ -244,50 +990,73 @@ class Downtime:
     the times specified by the "start" and "end" arguments.
 
     """
-    def __init__(self, changedHosts, icingaCmdFile):
+    def __init__(self, changedHosts, icingaCmdFile, window=600, duration=900, waitTimeout=60, runAs='nagios'):
+        """
+        Schedules downtime for every added host in changedHosts, starting now and able to start for the next window
+        seconds, lasting duration seconds. All the commands go to the command pipe in a single write, once nagios
+        is reading the pipe again (waiting up to waitTimeout seconds), as the runAs user when we are root.
+        """
         self.logger = logging.getLogger(__name__)
         self.icingaCmdFile = icingaCmdFile
         self.changedHosts = changedHosts
-        # F U Python and your random fail os.path permissions weirdness
-#         if not os.path.exists(self.icingaCmdFile):
-#            self.logger.critical("icinga cmdfile: %s does not exist, exiting." % (self.icingaCmdFile))
-#            exit(1)
-        dt = datetime.datetime.now()
-        dtStart_time = time.mktime(dt.timetuple())
-        end = dt + datetime.timedelta(minutes=10)
-        dtEnd_time = time.mktime(end.timetuple())
+        self.scheduled = 0
+
+        addedHosts = sorted([host for host in changedHosts if changedHosts[host] == 'added'])
+        if not addedHosts:
+            return
 
+        dtStart_time = int(time.time())
+        dtEnd_time = dtStart_time + window
         dtCommand = "SCHEDULE_HOST_SVC_DOWNTIME"
         dtComment = "Cloudgazer downtime to allow host to initialise"
         dtAuthor = "nagios"
-        # Duration in seconds
-        dtDuration = 900
-        runas = pwd.getpwnam('nagios')
-        self.logger.debug("current euid %s , uid %s " % (os.geteuid(), os.getuid()))
-        self.logger.debug("Waiting for 10 seconds for icinga to come backup")
-        time.sleep(10)
-        for hosts in changedHosts:
-
-            os.seteuid(runas.pw_uid)
-            if changedHosts[hosts] == 'added':
-                dtHost_name = hosts
-                dtMessage = "[%d] %s;%s;%d;%d;0;0;%d;%s;%s; \n " % (dtStart_time,
-                                                                    dtCommand,
-                                                                    dtHost_name,
-                                                                    dtStart_time,
-                                                                    dtEnd_time,
-                                                                    dtDuration,
-                                                                    dtAuthor,
-                                                                    dtComment)
-                try:
-                    self.logger.debug("current euid %s , uid %s " % (os.geteuid(),
-                                                                     os.getuid()))
-                    f = open(icingaCmdFile, 'w')
-                    self.logger.debug("message to icinga: %s " % (dtMessage))
-                    f.write(dtMessage)
-                except IOError:
-                    self.logger.debug("Cannot open icinga cmdfile: %s " % (self.icingaCmdFile))
-                f.close()
-            os.seteuid(0)
-
-        self.logger.debug("current euid %s , uid %s " % (os.geteuid(), os.getuid()))
+        dtMessages = ''.join(["[%d] %s;%s;%d;%d;0;0;%d;%s;%s\n" % (dtStart_time,
+                                                                   dtCommand,
+                                                                   dtHost_name,
+                                                                   dtStart_time,
+                                                                   dtEnd_time,
+                                                                   duration,
+                                                                   dtAuthor,
+                                                                   dtComment)
+                              for dtHost_name in addedHosts])
+
+        # only switch user when we can switch back
+        switchUser = os.geteuid() == 0 and runAs
+        if switchUser:
+            os.seteuid(pwd.getpwnam(runAs).pw_uid)
+        try:
+            self.logger.debug("current euid %s , uid %s " % (os.geteuid(), os.getuid()))
+            f = self._openCommandPipe(waitTimeout)
+            if f is None:
+                self.logger.critical("Cannot open icinga cmdfile: %s, no downtime scheduled" % (self.icingaCmdFile))
+                return
+            with f:
+                self.logger.debug("message to icinga: %s " % (dtMessages))
+                f.write(dtMessages)
+            self.scheduled = len(addedHosts)
+        except (IOError, OSError) as e:
+            self.logger.critical("Failed writing to icinga cmdfile: %s, %s" % (self.icingaCmdFile, e))
+        finally:
+            if switchUser:
+                os.seteuid(0)
+        self.logger.debug("Scheduled downtime for %d hosts" % (self.scheduled))
+
+    def _openCommandPipe(self, waitTimeout):
+        """
+        Opens the command pipe for writing once something (nagios, after it has restarted) is reading it.
+        Returns None if nothing is reading it within waitTimeout seconds.
+        """
+        deadline = time.time() + waitTimeout
+        while True:
+            try:
+                # a non blocking open of a pipe fails with ENXIO until there's a reader
+                fd = os.open(self.icingaCmdFile, os.O_WRONLY | os.O_NONBLOCK)
+                break
+            except OSError as e:
+                if e.errno not in (errno.ENXIO, errno.ENOENT) or time.time() >= deadline:
+                    self.logger.debug("Cannot open icinga cmdfile: %s, %s" % (self.icingaCmdFile, e))
+                    return None
+                time.sleep(0.5)
+        # back to blocking writes, so a full pipe waits for nagios to drain it instead of failing
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+        return os.fdopen(fd, 'w')
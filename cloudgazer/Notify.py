@@ -0,0 +1,210 @@
+import logging
+import Queue
+import socket
+import threading
+import time
+from boto.exception import BotoClientError, BotoServerError
+from AWS import SNSNotify
+from Metrics import Metrics
+from Nagios import RestartScheduler
+from Util import backoffDelay
+
+
+class Notifier:
+    """
+    Queues notifications and sends them to SNS from a background thread, so a run never waits on SNS.
+    Whatever has queued up by the time the worker gets to it is sent together: host changes merged into one
+    message, errors into another. With digestInterval (seconds) host changes are held and merged for up to that
+    long, so a daemon sends at most one host change message per interval; errors are always sent straight away.
+    Failed publishes are retried with backoff up to retries times over a single SNS connection, which is only
+    replaced after a failure. Messages are cut down to fit maxMessageBytes and subjects to SNS's 100 characters.
+    Call close() before exiting to send anything still queued or held. Hold paused() while switching the
+    process's effective user, which the worker thread would otherwise send as.
+    """
+    # SNS limits
+    MAX_MESSAGE_BYTES = 262144
+    MAX_SUBJECT_LENGTH = 100
+
+    def __init__(self, config, digestInterval=0, retries=3, maxMessageBytes=MAX_MESSAGE_BYTES, metrics=None):
+        self.logger = logging.getLogger(__name__)
+        self.config = config
+        self.enabled = config.get('enabled', True)
+        self.digestInterval = digestInterval
+        self.retries = retries
+        self.maxMessageBytes = min(maxMessageBytes, self.MAX_MESSAGE_BYTES)
+        self.metrics = metrics or Metrics()
+        self.hostname = socket.gethostname()
+        self.queue = Queue.Queue()
+        self._sns = None
+        self._digest = {}
+        self._digestStarted = None
+        self._digestRuns = 0
+        # held by the worker while sending, and by paused()
+        self._sending = threading.Lock()
+        self._worker = threading.Thread(target=self._work, name='notifier')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def hostChange(self, changedHosts):
+        """
+        Queues a notification of changedHosts ({hostIdent: 'added'|'removed'|'updated:<fields>'})
+        """
+        self.queue.put(('host_change', dict(changedHosts)))
+
+    def error(self, message=None, subject='Cloudgazer ERROR'):
+        """
+        Queues an error notification
+        """
+        self.queue.put(('error', message, subject))
+
+    def paused(self):
+        """
+        Returns a context manager that holds off sending, once any send in progress has finished
+        """
+        return self._sending
+
+    def close(self, timeout=60):
+        """
+        Sends everything queued or held for a digest, waiting at most timeout seconds for it
+        """
+        self.queue.put(('stop',))
+        self._worker.join(timeout)
+        if self._worker.is_alive():
+            self.logger.warning("Gave up waiting for notifications to be sent after %s seconds" % (timeout))
+
+    def _work(self):
+        while True:
+            try:
+                if self._digestStarted is None:
+                    events = [self.queue.get()]
+                else:
+                    timeout = self._digestStarted + self.digestInterval - time.time()
+                    events = [self.queue.get(True, max(timeout, 0.001))]
+            except Queue.Empty:
+                events = []
+            # batch up everything else already waiting
+            while True:
+                try:
+                    events.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            stopping = False
+            errors = []
+            for event in events:
+                if event[0] == 'host_change':
+                    self._addToDigest(event[1])
+                elif event[0] == 'error':
+                    errors.append(event[1:])
+                else:
+                    stopping = True
+
+            with self._sending:
+                try:
+                    if errors:
+                        self._sendErrors(errors)
+                    if self._digest and (stopping or time.time() - self._digestStarted >= self.digestInterval):
+                        self._sendDigest()
+                    elif not self._digest:
+                        self._digestStarted = None
+                except Exception:
+                    self.logger.exception('Unable to send notification')
+            if stopping:
+                return
+
+    def _addToDigest(self, changedHosts):
+        if self._digestStarted is None:
+            self._digestStarted = time.time()
+        self._digestRuns += 1
+        for host, change in changedHosts.items():
+            merged = RestartScheduler.mergeChange(self._digest.get(host), change)
+            if merged:
+                self._digest[host] = merged
+            else:
+                self._digest.pop(host, None)
+
+    def _sendDigest(self):
+        changedHosts, runs = self._digest, self._digestRuns
+        self._digest = {}
+        self._digestStarted = None
+        self._digestRuns = 0
+        header = "AWS Hosts in nagios have changed on %s" % (self.hostname)
+        if runs > 1:
+            header += " (over %d runs)" % (runs)
+        self._publish(self._generateHostChangeMessage(changedHosts, header + ":\n\n"), 'Cloudgazer Notification')
+
+    def _sendErrors(self, errors):
+        message = "On host: %s \n" % (self.hostname)
+        for error, subject in errors:
+            if error:
+                message += 'Cloudgazer encounted the following error:\n\n'
+                message += error + '\n\n'
+            else:
+                message += 'Cloudgazer encounted an unknown error,' \
+                           ' please investigate.\n\n'
+        self._publish(self._truncate(message), errors[0][1])
+
+    def _generateHostChangeMessage(self, changedHosts, header):
+        hostsAdded = []
+        hostsUpdated = []
+        hostsRemoved = []
+
+        for host in changedHosts:
+            if changedHosts[host] == 'added':
+                hostsAdded.append(host)
+            elif changedHosts[host] == 'removed':
+                hostsRemoved.append(host)
+            elif changedHosts[host].startswith('updated'):
+                fields = changedHosts[host].split(':')[1:]
+                hostsUpdated.append("%s (%s)" % (host, ', '.join(fields)))
+        sections = [("New hosts", sorted(hostsAdded)),
+                    ("Removed hosts", sorted(hostsRemoved)),
+                    ("Updated hosts", sorted(hostsUpdated))]
+
+        # list as many hosts of each kind as fit, halving the number listed until the message does
+        limit = max(len(hosts) for title, hosts in sections)
+        while True:
+            message = header
+            for title, hosts in sections:
+                listed = "\n ".join(hosts[:limit])
+                if len(hosts) > limit:
+                    listed += "\n ... and %d more" % (len(hosts) - limit)
+                message += "- %s (%s): \n%s\n\n" % (title, len(hosts), listed)
+            if len(message) <= self.maxMessageBytes or limit == 0:
+                return self._truncate(message)
+            limit //= 2
+
+    def _truncate(self, message):
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+        if len(message) <= self.maxMessageBytes:
+            return message
+        marker = "\n... (truncated)"
+        return message[:self.maxMessageBytes - len(marker)].decode('utf-8', 'ignore').encode('utf-8') + marker
+
+    def _publish(self, message, subject):
+        subject = subject[:self.MAX_SUBJECT_LENGTH]
+        # Send notifications unless the config specifically
+        # disables it, otherwise just log
+        if not self.enabled:
+            self.logger.debug('Notifications are disabled.'
+                              "We Would've sent this: %s" % message)
+            return
+        for attempt in range(self.retries + 1):
+            try:
+                if self._sns is None:
+                    self._sns = SNSNotify(region=self.config['sns']['region'],
+                                          topic=self.config['sns']['topic'])
+                self._sns.publish(message=message, subject=subject)
+                self.metrics.incr('notifications_sent')
+                return
+            except (BotoClientError, BotoServerError, IOError) as e:
+                # start again with a fresh connection
+                self._sns = None
+                if attempt == self.retries:
+                    self.metrics.incr('notifications_failed')
+                    self.logger.error("Unable to send notification '%s': %s" % (subject, e))
+                    return
+                delay = backoffDelay(attempt)
+                self.logger.warning("Sending notification failed (%s), retrying in %.1f seconds" % (e, delay))
+                time.sleep(delay)
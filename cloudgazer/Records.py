@@ -0,0 +1,71 @@
+from operator import itemgetter
+
+_item = tuple.__getitem__
+
+
+class HostRecord(tuple):
+    """
+    A nagios host as a tuple of its field values, in the order of the nagios fields its type was made with by
+    makeHostRecord. The field names and their positions are held once on the type, so a host costs no more than a
+    tuple of its values. Records compare equal when every field is equal, and hash by the host identifier.
+    Read a field by name with get(), or in a loop over many hosts with the type's getter() for that field.
+    """
+    __slots__ = ()
+    FIELDS = ()
+    INDEX = {}
+    IDENT_FIELD = None
+    IDENT = None
+
+    def __hash__(self):
+        if self.IDENT is None:
+            return tuple.__hash__(self)
+        return hash(_item(self, self.IDENT))
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.asDict())
+
+    def ident(self):
+        return _item(self, self.IDENT)
+
+    def get(self, field, default=None):
+        index = self.INDEX.get(field)
+        return default if index is None else _item(self, index)
+
+    def keys(self):
+        return list(self.FIELDS)
+
+    def items(self):
+        return zip(self.FIELDS, self)
+
+    def asDict(self):
+        return dict(zip(self.FIELDS, self))
+
+    def diff(self, other):
+        """
+        Returns the names of the fields, other than the host identifier, whose values differ from other's
+        """
+        return [field for field, mine, theirs in zip(self.FIELDS, self, other)
+                if mine != theirs and field != self.IDENT_FIELD]
+
+    @classmethod
+    def getter(cls, field):
+        """
+        Returns a function that reads field from a host
+        """
+        return itemgetter(cls.INDEX[field])
+
+    @classmethod
+    def fromDict(cls, host, missingValue=''):
+        return cls([host.get(field, missingValue) for field in cls.FIELDS])
+
+
+def makeHostRecord(fields, hostIdent=None):
+    """
+    Returns a HostRecord type for hosts with these nagios fields, in this order
+    """
+    fields = tuple(fields)
+    return type('HostRecord', (HostRecord,), {'__slots__': (),
+                                              'FIELDS': fields,
+                                              'INDEX': dict((field, i) for i, field in enumerate(fields)),
+                                              'IDENT_FIELD': hostIdent,
+                                              'IDENT': fields.index(hostIdent) if hostIdent else None})
@@ -0,0 +1,100 @@
+import logging
+import Queue
+import sys
+import traceback
+from multiprocessing.pool import ThreadPool
+
+
+class StageGraph:
+    """
+    Runs the stages of a run on a thread pool, each one as soon as the stages it comes after have finished.
+    Stages are functions of no arguments, added in the order they would run one after another, and their return
+    values are kept in results by stage name. A stage that raises (or exits) doesn't stop the stages that don't
+    depend on it, but the stages after it are skipped. check() then logs the failures in the order the stages were
+    added and re-raises the first, so errors come out the same however the stages happened to interleave.
+    With a profiler (see Metrics.Profiler) each stage is profiled on the pool thread it runs on.
+    """
+    def __init__(self, workers=4, profiler=None):
+        self.logger = logging.getLogger(__name__)
+        self.workers = workers
+        self.profiler = profiler
+        self.stages = []
+        self.results = {}
+        self.failures = []
+        self.skipped = []
+
+    def add(self, name, func, after=()):
+        """
+        Adds a stage, to run after the (already added) stages named in after
+        """
+        names = [stage[0] for stage in self.stages]
+        if name in names:
+            raise ValueError("Stage %s added twice" % (name))
+        for dependency in after:
+            if dependency not in names:
+                raise ValueError("Stage %s comes after unknown stage %s" % (name, dependency))
+        self.stages.append((name, func, list(after)))
+
+    def run(self):
+        """
+        Runs every stage that can run, returning the results
+        """
+        if not self.stages:
+            return self.results
+        order = dict((stage[0], i) for i, stage in enumerate(self.stages))
+        waiting = list(self.stages)
+        failed = set()
+        running = 0
+        finished = Queue.Queue()
+        pool = ThreadPool(min(self.workers, len(self.stages)))
+        try:
+            while waiting or running:
+                # stages only come after earlier stages, so one pass in order settles every chain
+                for stage in list(waiting):
+                    name, func, after = stage
+                    if [dependency for dependency in after if dependency in failed]:
+                        waiting.remove(stage)
+                        failed.add(name)
+                        self.skipped.append(name)
+                        self.logger.warning("Skipping stage %s, a stage it comes after failed" % (name))
+                    elif not [dependency for dependency in after if dependency not in self.results]:
+                        waiting.remove(stage)
+                        running += 1
+                        pool.apply_async(self._call, (name, func), callback=finished.put)
+                if not running:
+                    break
+                # no timeout, which python 2 implements by polling, adding up to 50ms to every stage
+                name, result, excInfo = finished.get()
+                running -= 1
+                if excInfo:
+                    failed.add(name)
+                    self.failures.append((name, excInfo))
+                else:
+                    self.results[name] = result
+        finally:
+            pool.close()
+            pool.join()
+        self.failures.sort(key=lambda failure: order[failure[0]])
+        return self.results
+
+    def check(self):
+        """
+        Logs every failed stage, in order, and re-raises the first failure
+        """
+        for name, (excType, excValue, tb) in self.failures:
+            if issubclass(excType, SystemExit):
+                self.logger.critical("Stage %s exited" % (name))
+            else:
+                self.logger.critical("Stage %s failed: %s" % (name, ''.join(traceback.format_exception(excType, excValue, tb)).strip()))
+        if self.failures:
+            excType, excValue, tb = self.failures[0][1]
+            raise excType, excValue, tb
+
+    def _call(self, name, func):
+        try:
+            if self.profiler:
+                return name, self.profiler.call(func), None
+            return name, func(), None
+        except BaseException:
+            # exits too, as a pool worker that exits would leave the run waiting for it forever
+            return name, None, sys.exc_info()
@@ -0,0 +1,487 @@
+import argparse
+from itertools import izip
+import logging
+import mmap
+import os
+import os.path
+import sqlite3
+import struct
+from operator import itemgetter
+import yaml
+from Records import makeHostRecord
+
+
+class SQLiteStore:
+    """
+    Keeps the stored hosts in the nagios_hosts table of an SQLite database, one column per nagios field.
+    If the table was created with other fields, the change is kept in pendingMigration and the stored hosts are
+    read back with the new fields blank, until replace() swaps in a table of the new fields.
+    """
+    JOURNAL_MODES = ['delete', 'truncate', 'persist', 'memory', 'wal', 'off']
+    SYNCHRONOUS_MODES = ['off', 'normal', 'full', 'extra']
+
+    def __init__(self, databaseFile, hostIdent, nagiosFields, recordType, journalMode=None, synchronous=None):
+        self.logger = logging.getLogger(__name__)
+        self.databaseFile = databaseFile
+        self.hostIdent = hostIdent
+        self.nagiosFields = nagiosFields
+        self.recordType = recordType
+        # (added fields, removed fields) when the table still has the fields of an older mapping
+        self.pendingMigration = None
+        # what to select for each nagios field, a blank for the ones a pending migration adds
+        self._selectFields = list(self.nagiosFields)
+
+        if not os.path.exists(self.databaseFile):
+            self.logger.warning('SQLite database does not exist, creating new one.')
+
+        # Connect to sqlite database and create nagios_hosts table if it doesn't exist
+        try:
+            # changes may be written from a worker thread, while the run carries on with other stages
+            self.dbconn = sqlite3.connect(databaseFile, check_same_thread=False)
+            # read text back as the plain strings we stored, rather than converting it to unicode and back
+            self.dbconn.text_factory = str
+            self.cur = self.dbconn.cursor()
+            self._setPragmas(journalMode, synchronous)
+            # check this database was created with the same host fields as we have now
+            columns = [(str(row[1]), row[5]) for row in self.cur.execute('PRAGMA table_info(nagios_hosts);')]
+            if not columns:
+                self.logger.debug('No table called nagios_hosts found. Creating...')
+                self.cur.execute(self._createTable('nagios_hosts'))
+            else:
+                storedFields = [name for name, primaryKey in columns]
+                storedIdent = [name for name, primaryKey in columns if primaryKey]
+                if sorted(storedFields) != sorted(self.nagiosFields) or storedIdent != [self.hostIdent]:
+                    self._checkMigration(storedFields)
+
+        except sqlite3.Error as e:
+            self.logger.critical("Something bad happened trying to use the SQLite database, error: %s" % e.args[0])
+            self.dbconn.close()
+            exit(1)
+
+    def _createTable(self, table):
+        return "CREATE TABLE %s(%s TEXT, PRIMARY KEY (%s))" % (table, ' TEXT, '.join(self.nagiosFields), self.hostIdent)
+
+    def _checkMigration(self, storedFields):
+        """
+        Works out the fields the nagios_hosts table needs adding and removing to match the mappings
+        """
+        if self.hostIdent not in storedFields:
+            # without the host identifier the stored hosts can't be matched up with discovered ones
+            self.logger.critical("Host identifier %s is not stored in the database, so it can not be migrated to the "
+                                 "new fields. Delete database if you are sure yaml is correct" % (self.hostIdent))
+            self.logger.critical("Current database fields: %s" % (', '.join(storedFields)))
+            self.logger.critical("New fields: %s" % (', '.join(self.nagiosFields)))
+            exit(1)
+        self.pendingMigration = ([field for field in self.nagiosFields if field not in storedFields],
+                                 [field for field in storedFields if field not in self.nagiosFields])
+        self._selectFields = [field if field in storedFields else "''" for field in self.nagiosFields]
+        self.logger.warning("Fields in database do not match yaml file, migrating. Adding: %s, removing: %s" %
+                            (', '.join(self.pendingMigration[0]) or 'none', ', '.join(self.pendingMigration[1]) or 'none'))
+
+    def load(self, whereField=None, whereValues=None):
+        """
+        Returns the stored hosts, or if whereField is given only those whose whereField value is in whereValues
+        """
+        hosts = []
+        selectStr = "SELECT %s FROM nagios_hosts" % (','.join(self._selectFields))
+        if whereField is None:
+            queries = [(selectStr + ';', [])]
+        else:
+            # stay under sqlite's limit on the number of parameters in one statement
+            whereValues = list(whereValues)
+            queries = [("%s WHERE %s IN (%s);" % (selectStr, whereField, ', '.join(['?'] * len(chunk))), chunk)
+                       for chunk in [whereValues[i:i + 500] for i in range(0, len(whereValues), 500)]]
+        for query, params in queries:
+            # rows come back in nagiosFields order, just like a record
+            hosts.extend(map(self.recordType, self.dbconn.execute(query, params)))
+        return hosts
+
+    def get(self, ident):
+        """
+        Returns the stored host with this identifier, or None
+        """
+        row = self.dbconn.execute("SELECT %s FROM nagios_hosts WHERE %s=?;" % (','.join(self._selectFields),
+                                                                                self.hostIdent), [ident]).fetchone()
+        return self.recordType(row) if row else None
+
+    def empty(self):
+        return self.dbconn.execute("SELECT 1 FROM nagios_hosts LIMIT 1;").fetchone() is None
+
+    def applyChanges(self, added, updated, removed):
+        """
+        Writes the added, updated and removed hosts from a diff to the database using
+        parameterized executemany statements inside a single transaction.
+        Raises the sqlite3.Error if it fails, leaving the stored hosts as they were.
+        """
+        if not (added or updated or removed):
+            return
+        if self.pendingMigration:
+            getIdent = self.recordType.getter(self.hostIdent)
+            changed = set([getIdent(host) for host in removed + updated + added])
+            self.replace([host for host in self.load() if getIdent(host) not in changed] + added + updated)
+            return
+        ident = self.hostIdent
+        updateFields = [field for field in self.nagiosFields if field != ident]
+        insertSQL = "INSERT INTO nagios_hosts(%s) VALUES(%s);" % (', '.join(self.nagiosFields),
+                                                                 ', '.join(['?'] * len(self.nagiosFields)))
+        updateSQL = "UPDATE nagios_hosts SET %s WHERE %s=?;" % (', '.join([field + '=?' for field in updateFields]), ident)
+        deleteSQL = "DELETE FROM nagios_hosts WHERE %s=?;" % (ident)
+
+        self.logger.debug("Writing to DB: %d added, %d updated, %d removed" % (len(added), len(updated), len(removed)))
+        try:
+            # the connection context manager commits on success and rolls back on error
+            with self.dbconn:
+                if added:
+                    self.dbconn.executemany(insertSQL, [tuple(host) for host in added])
+                if updated and updateFields:
+                    self.dbconn.executemany(updateSQL, [[host.get(field) for field in updateFields] + [host.ident()]
+                                                        for host in updated])
+                if removed:
+                    self.dbconn.executemany(deleteSQL, [[host.ident()] for host in removed])
+        except sqlite3.Error as e:
+            self.logger.critical("Failed to write host changes to the SQLite database, error: %s" % e.args[0])
+            raise
+
+    def replace(self, hosts):
+        """
+        Replaces every stored host with hosts, by filling a new table of the current fields and swapping it in
+        for nagios_hosts, all in a single transaction. This is also how a pending migration is applied.
+        Raises the sqlite3.Error if it fails, leaving the stored hosts as they were.
+        """
+        insertSQL = "INSERT INTO nagios_hosts_new(%s) VALUES(%s);" % (', '.join(self.nagiosFields),
+                                                                     ', '.join(['?'] * len(self.nagiosFields)))
+        # the sqlite3 module commits before any CREATE or DROP, so manage the transaction ourselves
+        isolationLevel = self.dbconn.isolation_level
+        self.dbconn.isolation_level = None
+        try:
+            self.cur.execute("BEGIN;")
+            self.cur.execute("DROP TABLE IF EXISTS nagios_hosts_new;")
+            self.cur.execute(self._createTable('nagios_hosts_new'))
+            self.cur.executemany(insertSQL, [tuple(host) for host in hosts])
+            self.cur.execute("DROP TABLE IF EXISTS nagios_hosts;")
+            self.cur.execute("ALTER TABLE nagios_hosts_new RENAME TO nagios_hosts;")
+            self.cur.execute("COMMIT;")
+        except sqlite3.Error as e:
+            self.logger.critical("Failed to replace the hosts in the SQLite database, error: %s" % e.args[0])
+            try:
+                self.cur.execute("ROLLBACK;")
+            except sqlite3.Error:
+                pass
+            raise
+        finally:
+            self.dbconn.isolation_level = isolationLevel
+        if self.pendingMigration:
+            self.logger.info("Migrated database to fields: %s" % (', '.join(self.nagiosFields)))
+        self.pendingMigration = None
+        self._selectFields = list(self.nagiosFields)
+
+    def close(self):
+        self.dbconn.close()
+
+    def _setPragmas(self, journalMode, synchronous):
+        """
+        Applies the optional journal_mode and synchronous pragmas from the database config
+        """
+        # yaml reads an unquoted off as False
+        if journalMode is False:
+            journalMode = 'off'
+        if synchronous is False:
+            synchronous = 'off'
+        if journalMode:
+            if str(journalMode).lower() not in self.JOURNAL_MODES:
+                self.logger.critical("Unknown sqlite journal_mode: %s, expected one of %s" % (journalMode, ', '.join(self.JOURNAL_MODES)))
+                exit(1)
+            self.cur.execute("PRAGMA journal_mode=%s;" % str(journalMode).lower())
+            self.logger.debug("SQLite journal mode: %s" % self.cur.fetchone()[0])
+        if synchronous:
+            if str(synchronous).lower() not in self.SYNCHRONOUS_MODES:
+                self.logger.critical("Unknown sqlite synchronous mode: %s, expected one of %s" % (synchronous, ', '.join(self.SYNCHRONOUS_MODES)))
+                exit(1)
+            self.cur.execute("PRAGMA synchronous=%s;" % str(synchronous).lower())
+
+
+class SnapshotStore:
+    """
+    Keeps the stored hosts in a binary snapshot file, read through mmap. The file holds a header (magic, host
+    count and the nagios field names), an index of little endian 32 bit offsets, and the hosts sorted by host
+    identifier, each as its field values each followed by a NUL. Opening it only reads the header, get() binary
+    searches the index, load() splits all the hosts apart in one go, and every write replaces the whole file
+    atomically, copying the unchanged runs of hosts across as they are. A snapshot of other fields is read back
+    with the new fields blank (see pendingMigration), and written out in the new fields by the next write.
+    Only opening it and looking up single hosts are quicker than SQLite: loading every host, and writing a diff,
+    which is what each run does, are a little slower (see benchmarks/bench_store.py).
+    """
+    MAGIC = 'CGSNAP01'
+    HEADER = struct.Struct('<8sII')
+
+    def __init__(self, snapshotFile, hostIdent, nagiosFields, recordType):
+        self.logger = logging.getLogger(__name__)
+        self.snapshotFile = snapshotFile
+        self.hostIdent = hostIdent
+        self.nagiosFields = nagiosFields
+        self.recordType = recordType
+        self._map = None
+        self.count = 0
+        self.pendingMigration = None
+
+        try:
+            if not os.path.exists(self.snapshotFile):
+                self.logger.warning('Snapshot file does not exist, creating new one.')
+                self.replace([])
+            else:
+                self._open()
+        except (IOError, OSError, ValueError, struct.error, mmap.error):
+            exit(1)
+
+    def _open(self):
+        if self._map:
+            self._map.close()
+        try:
+            with open(self.snapshotFile, 'rb') as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, self.count, fieldsLength = self.HEADER.unpack_from(self._map, 0)
+            if magic != self.MAGIC:
+                raise ValueError('not a cloudgazer snapshot')
+            fieldsStart = self.HEADER.size
+            fields = self._map[fieldsStart:fieldsStart + fieldsLength].split('\0')
+        except (IOError, ValueError, struct.error, mmap.error) as e:
+            self.logger.critical("Unable to read snapshot file %s: %s" % (self.snapshotFile, e))
+            raise
+
+        if self.hostIdent not in fields:
+            # without the host identifier the stored hosts can't be matched up with discovered ones
+            self.logger.critical("Host identifier %s is not stored in the snapshot, so it can not be migrated to the "
+                                 "new fields. Delete snapshot if you are sure yaml is correct" % (self.hostIdent))
+            self.logger.critical("Snapshot fields: %s" % (', '.join(fields)))
+            self.logger.critical("New fields: %s" % (', '.join(self.nagiosFields)))
+            exit(1)
+        self.pendingMigration = None
+        if sorted(fields) != sorted(self.nagiosFields):
+            self.pendingMigration = ([field for field in self.nagiosFields if field not in fields],
+                                     [field for field in fields if field not in self.nagiosFields])
+            self.logger.warning("Fields in snapshot do not match yaml file, migrating. Adding: %s, removing: %s" %
+                                (', '.join(self.pendingMigration[0]) or 'none',
+                                 ', '.join(self.pendingMigration[1]) or 'none'))
+        self.fields = fields
+        self._identIndex = fields.index(self.hostIdent)
+        # a snapshot written with other fields, or in another order, is read back in ours (None is a blank field)
+        self._order = None
+        if fields != list(self.nagiosFields):
+            self._order = [fields.index(field) if field in fields else None for field in self.nagiosFields]
+        self._indexStart = fieldsStart + fieldsLength
+        self._dataStart = self._indexStart + 4 * (self.count + 1)
+
+    def _offset(self, i):
+        return self._dataStart + struct.unpack_from('<I', self._map, self._indexStart + 4 * i)[0]
+
+    def _values(self, i):
+        return self._map[self._offset(i):self._offset(i + 1) - 1].split('\0')
+
+    def _toRecord(self, values):
+        if self._order:
+            values = [values[index] if index is not None else '' for index in self._order]
+        return self.recordType(values)
+
+    def load(self, whereField=None, whereValues=None):
+        """
+        Returns the stored hosts, or if whereField is given only those whose whereField value is in whereValues
+        """
+        if not self.count:
+            return []
+        dataEnd = self._dataStart + struct.unpack_from('<I', self._map, self._indexStart + 4 * self.count)[0]
+        # every value ends in a NUL, so one split gives all the values in order, grouped into hosts by izip
+        values = iter(self._map[self._dataStart:dataEnd - 1].split('\0'))
+        rows = izip(*[values] * len(self.fields))
+        if self._order:
+            rows = [[row[index] if index is not None else '' for index in self._order] for row in rows]
+        hosts = map(self.recordType, rows)
+        if whereField is not None:
+            getField = self.recordType.getter(whereField)
+            whereValues = set(whereValues)
+            hosts = [host for host in hosts if getField(host) in whereValues]
+        return hosts
+
+    def _find(self, ident):
+        """
+        Binary searches for ident, returning (position, values) if it is stored, otherwise (insert position, None)
+        """
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            values = self._values(middle)
+            if values[self._identIndex] < ident:
+                low = middle + 1
+            elif values[self._identIndex] > ident:
+                high = middle
+            else:
+                return middle, values
+        return low, None
+
+    def get(self, ident):
+        """
+        Returns the stored host with this identifier, or None
+        """
+        values = self._find(ident)[1]
+        return self._toRecord(values) if values is not None else None
+
+    def empty(self):
+        return self.count == 0
+
+    def applyChanges(self, added, updated, removed):
+        """
+        Applies the added, updated and removed hosts from a diff, rewriting the snapshot. Raises the error if the
+        snapshot can't be written, leaving the stored hosts as they were.
+        """
+        if not (added or updated or removed):
+            return
+        self.logger.debug("Writing snapshot: %d added, %d updated, %d removed" % (len(added), len(updated), len(removed)))
+        if self._order:
+            # the stored hosts have other fields, or the same in another order, so rewrite them all in ours
+            getIdent = self.recordType.getter(self.hostIdent)
+            changed = set([getIdent(host) for host in removed + updated + added])
+            self.replace([host for host in self.load() if getIdent(host) not in changed] + added + updated)
+            return
+
+        # (position, 0, ident, record) inserts a host before the stored host at position, (position, 1, '', None)
+        # drops it; hosts inserted at the same position go in identifier order, whatever field comes first
+        edits = []
+        for host in removed + updated + added:
+            position, values = self._find(host.ident())
+            if values is not None:
+                edits.append((position, 1, '', None))
+        for host in added + updated:
+            edits.append((self._find(host.ident())[0], 0, host.ident(), '\0'.join(host) + '\0'))
+        edits.sort()
+
+        oldOffsets = struct.unpack_from('<%dI' % (self.count + 1), self._map, self._indexStart)
+        chunks = []
+        offsets = [0]
+
+        def copy(start, end):
+            # copy the stored hosts start to end across unchanged, shifting their offsets to where they now begin
+            shift = offsets[-1] - oldOffsets[start]
+            chunks.append(self._map[self._dataStart + oldOffsets[start]:self._dataStart + oldOffsets[end]])
+            offsets.extend([offset + shift for offset in oldOffsets[start + 1:end + 1]])
+
+        position = 0
+        for editPosition, drop, ident, record in edits:
+            if editPosition > position:
+                copy(position, editPosition)
+                position = editPosition
+            if drop:
+                position = max(position, editPosition + 1)
+            else:
+                chunks.append(record)
+                offsets.append(offsets[-1] + len(record))
+        if position < self.count:
+            copy(position, self.count)
+        self._write(offsets, chunks)
+
+    def replace(self, hosts):
+        """
+        Replaces every stored host with hosts, by writing a new snapshot and renaming it over the old one
+        """
+        hosts = sorted(hosts, key=itemgetter(self.recordType.INDEX[self.hostIdent]))
+        records = ['\0'.join(host) + '\0' for host in hosts]
+        offsets = [0]
+        for record in records:
+            offsets.append(offsets[-1] + len(record))
+        self._write(offsets, records)
+
+    def _write(self, offsets, chunks):
+        """
+        Writes a new snapshot of the hosts in chunks, whose record offsets are given, and renames it over the old one
+        """
+        fields = '\0'.join(self.nagiosFields)
+        tmpFile = "%s.tmp-%d" % (self.snapshotFile, os.getpid())
+        try:
+            with open(tmpFile, 'wb') as f:
+                f.write(self.HEADER.pack(self.MAGIC, len(offsets) - 1, len(fields)))
+                f.write(fields)
+                f.write(struct.pack('<%dI' % len(offsets), *offsets))
+                f.write(''.join(chunks))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmpFile, self.snapshotFile)
+        except (IOError, OSError, struct.error) as e:
+            self.logger.critical("Failed to write snapshot file %s: %s" % (self.snapshotFile, e))
+            raise
+        if self.pendingMigration:
+            self.logger.info("Migrated snapshot to fields: %s" % (', '.join(self.nagiosFields)))
+        self._open()
+
+    def close(self):
+        if self._map:
+            self._map.close()
+            self._map = None
+
+
+STORES = {'sqlite': SQLiteStore, 'snapshot': SnapshotStore}
+
+
+def openStore(storeType, location, hostIdent, nagiosFields, recordType=None, journalMode=None, synchronous=None):
+    """
+    Opens the database: type store at location
+    """
+    recordType = recordType or makeHostRecord(nagiosFields, hostIdent)
+    if storeType == 'sqlite':
+        return SQLiteStore(location, hostIdent, nagiosFields, recordType,
+                           journalMode=journalMode, synchronous=synchronous)
+    return SnapshotStore(location, hostIdent, nagiosFields, recordType)
+
+
+def migrate():
+    """
+    Copies the stored hosts from the database in the config file to a new store of another type, i.e.
+    cloudgazer-migrate-db --to-type snapshot --to ~/cloudgazer.snapshot
+    Point database: type and location at the new store afterwards.
+    """
+    argParse = argparse.ArgumentParser(description='Copy the cloudgazer host database to another store type')
+    argParse.add_argument('-c', '--config_file',
+                          dest='configFile',
+                          default='~/.cloudgazer.yaml',
+                          help='Cloudgazer configuration file location.'
+                               ' Defaults to ~/.cloudgazer.yaml')
+    argParse.add_argument('--to-type',
+                          dest='toType',
+                          required=True,
+                          choices=sorted(STORES),
+                          help='Store type to migrate to')
+    argParse.add_argument('--to',
+                          dest='toLocation',
+                          required=True,
+                          help='Location of the new store, which is replaced')
+    args = argParse.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger(__name__)
+
+    configFile = os.path.expanduser(args.configFile)
+    if not os.path.exists(configFile):
+        print "Error: Configuration file %s doesn't exist." % (args.configFile)
+        exit(1)
+    with open(configFile) as f:
+        config = yaml.safe_load(f)
+    hostIdent = config['nagios']['host_identifier']
+    nagiosFields = [config['mappings'][map]['nagios_field'] for map in config['mappings']]
+    fromType = config['database']['type']
+    fromLocation = os.path.expanduser(config['database']['location'])
+    toLocation = os.path.expanduser(args.toLocation)
+    if fromType not in STORES:
+        logger.critical("Database type: %s, not currently supported" % (fromType))
+        exit(1)
+    if not os.path.exists(fromLocation):
+        logger.critical("Database %s doesn't exist" % (fromLocation))
+        exit(1)
+    if os.path.abspath(fromLocation) == os.path.abspath(toLocation):
+        logger.critical('The new store needs a different location')
+        exit(1)
+
+    source = openStore(fromType, fromLocation, hostIdent, nagiosFields,
+                       journalMode=config['database'].get('journal_mode'),
+                       synchronous=config['database'].get('synchronous'))
+    hosts = source.load()
+    source.close()
+    destination = openStore(args.toType, toLocation, hostIdent, nagiosFields)
+    destination.replace(hosts)
+    destination.close()
+    logger.info("Copied %d hosts from %s %s to %s %s" % (len(hosts), fromType, fromLocation, args.toType, toLocation))
@@ -0,0 +1,21 @@
+import os
+import random
+
+
+def writeAtomically(path, data):
+    """
+    Writes data to a temporary file next to path and renames it over path, so a reader (or a run that dies part
+    way through) only ever sees the old or the new contents
+    """
+    tmpFile = "%s.tmp-%d" % (path, os.getpid())
+    with open(tmpFile, 'w') as f:
+        f.write(data)
+    os.rename(tmpFile, path)
+
+
+def backoffDelay(attempt):
+    """
+    Returns the seconds to wait before retrying after attempt (counting from 0) failed: doubling each time up to
+    30 seconds, and jittered so retries from several threads or processes spread out
+    """
+    return min(2 ** attempt, 30) * random.uniform(0.5, 1.0)
@@ -4,16 +4,31 @@
 # Cloudgazer: Discovers EC2 instances and generates nagios config for them
 
 import argparse
+from functools import partial
 import logging
 import os.path
-import socket
+import random
+import time
 import yaml
 from AWS import Hosts as AWSHosts
-from AWS import SNSNotify
+from Events import SpoolEvents
+from Events import SQSEvents
+from Metrics import Metrics
+from Metrics import Profiler
 from Nagios import Config as NagiosConfig
+from Nagios import HostDigests as NagiosHostDigests
 from Nagios import Writer as NagiosWriter
+from Nagios import StagedConfig as NagiosStagedConfig
 from Nagios import Manager as NagiosManager
+from Nagios import RestartScheduler as NagiosRestartScheduler
+from Nagios import ShardRing as NagiosShardRing
 from Nagios import Downtime as NagiosDowntime
+from Nagios import Validator as NagiosValidator
+from Nagios import VerifyCache as NagiosVerifyCache
+from Notify import Notifier
+from Records import makeHostRecord
+from Stages import StageGraph
+from Util import writeAtomically
 
 
 def main():
@@ -30,6 +45,15 @@ def main():
                           default="info",
                           help='Log Level for output messages,'
                                ' CRITICAL, ERROR, WARNING, INFO or DEBUG')
+    argParse.add_argument('-d', '--daemon',
+                          dest='daemon',
+                          action='store_true',
+                          help='Keep running, polling for changes every daemon: interval seconds'
+                               ' instead of running once')
+    argParse.add_argument('-p', '--profile',
+                          dest='profile',
+                          required=False,
+                          help='Profile the whole run with cProfile and dump the stats to this file')
     args = argParse.parse_args()
 
     # set up logging
@@ -38,7 +62,6 @@ def main():
         print 'Invalid log level: %s' % args.loglevel
         exit(1)
     logging.basicConfig(level=numeric_level)
-    logger = logging.getLogger(__name__)
 
     # Parse configuration file
     configFile = os.path.expanduser(args.configFile)
@@ -49,158 +72,502 @@ def main():
     config = yaml.safe_load(conf_fo)
     conf_fo.close()
 
-    # get ec2 region
-    region = config['ec2']['region']
-    assumed_role_arn = config['ec2']['assumed_role_arn']
-
-    # get paths for nagios config
-    nagiosDir = os.path.expanduser(config['nagios']['host_dir'])
-    hostIdent = config['nagios']['host_identifier']
-    nagiosFields = [config['mappings'][map]['nagios_field'] for map in config['mappings']]
-    nagiosSplitBy = config['nagios']['separate_hosts_by']
-    icingaCmdFile = config['nagios']['command_file']
-    if nagiosSplitBy not in nagiosFields and nagiosSplitBy.lower() != 'none':
-        logger.critical('separate_hosts_by not set to a known nagios host field')
-        exit(1)
-
-    # get database config
-    if config['database']['type'] != 'sqlite':
-        logger.critical('Database type: %s, not currently supported. Only sqlite for now')
-        exit(1)
-    sqliteDbFile = os.path.expanduser(config['database']['location'])
-
-    # Grab the bits of the config we need to give to AWSHosts class
-    templateMap = config['template_map']
-    mappings = config['mappings']
-    filters = config['ec2']['filters']
-    if 'exclude_tag' in config['ec2']:
-        exclude_tag = config['ec2']['exclude_tag']
-    else:
-        exclude_tag = ''
-
-    # Notification config
-    notification_conf = config['notifications']
-
-    awsHosts = AWSHosts(region=region,
-                        assumed_role_arn=assumed_role_arn,
-                        filters=filters,
-                        mappings=mappings,
-                        templateMap=templateMap,
-                        exclude_tag=exclude_tag)
-
-#    print len(awsHosts.instances)
-    for host in awsHosts.hosts:
-        for map in config['mappings']:
-            logger.debug("Host: %s, Nagios field: %s, Value: %s" % (host["host_name"],
-                                                                    config['mappings'][map]['nagios_field'],
-                                                                    host[config['mappings'][map]['nagios_field']]))
-
-    nagiosConf = NagiosConfig(configPath=nagiosDir,
-                              databaseFile=sqliteDbFile,
-                              hostIdent=hostIdent,
-                              nagiosFields=nagiosFields)
-    changedHosts = nagiosConf.updateDB(awsHosts.hosts)
-
-    if len(changedHosts) > 0:
-        logger.debug('Host list changed, writing nagios config')
-        NagiosWriter(configDir=nagiosDir,
-                     hosts=awsHosts.hosts,
-                     changedHosts=changedHosts,
-                     splitBy=nagiosSplitBy)
-        Notify(method='SNS',
-               changedHosts=changedHosts,
-               config=notification_conf)
-        nagManager = NagiosManager(config=config['nagios'])
-        nag_config_check = nagManager.verifyConfig()
-        if nag_config_check['ok']:
-            if nagManager.restart():
-                logger.debug('Nagios successfully restarted')
-                if changedHosts:
-                    NagiosDowntime(changedHosts, icingaCmdFile)
-                    logger.debug('Scheduled downtime for hosts')
+    profiler = None
+    if args.profile:
+        profiler = Profiler()
+        profiler.enable()
+    try:
+        cloudgazer = Cloudgazer(config, profiler=profiler)
+        try:
+            if args.daemon:
+                cloudgazer.runForever()
             else:
-                msg = 'Failed to restart nagios'
-                logger.critical(msg)
-                Notify(method='SNS',
-                       config=notification_conf,
-                       type='error',
-                       message=msg,
-                       subject='Cloudgazer ERROR')
+                cloudgazer.run()
+        finally:
+            cloudgazer.close()
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump(os.path.expanduser(args.profile))
 
-        else:
-            msg = 'Failed to verify nagios config'
-            logger.critical(msg)
-            msg = msg + "\n" + nag_config_check['output']
-            Notify(method='SNS',
-                   config=notification_conf,
-                   type='error',
-                   message=msg,
-                   subject='Cloudgazer ERROR')
-    else:
-        logger.debug('No change to host list. Nothing to do.')
-
-
-class Notify:
-    def __init__(self, config, method, type='host_change', message=None,
-                 changedHosts=None, subject='Cloudgazer Notification'):
+
+class Cloudgazer:
+    """
+    Holds the parsed config, and after the first run the AWS discovery (with its credentials and connections) and
+    the host database with the last host snapshot, so a long running process only pays for them once.
+    A Metrics.Profiler given as profiler also profiles the work done on pool threads.
+    """
+    def __init__(self, config, profiler=None):
         self.logger = logging.getLogger(__name__)
-        self.changedHosts = changedHosts
         self.config = config
-        self.hostname = socket.gethostname()
-        if 'enabled' in config:
-            self.notifications_enabled = config['enabled']
+        self.profiler = profiler
+        self.awsHosts = None
+        self.nagiosConf = None
+        self.restartScheduler = None
+        self.hostDigests = None
+        self.eventSource = None
+        self.lastReconcile = None
+        self.metrics = Metrics()
+
+        # get ec2 regions and roles, either can be a list
+        self.region = config['ec2']['region']
+        self.assumed_role_arn = config['ec2']['assumed_role_arn']
+        self.maxWorkers = config['ec2'].get('max_workers', 8)
+        self.callTimeout = config['ec2'].get('call_timeout', 30)
+        self.retries = config['ec2'].get('retries', 3)
+        self.pageSize = config['ec2'].get('page_size', 500)
+        self.endpoint = config['ec2'].get('endpoint')
+        self.recordFile = config['ec2'].get('record_file')
+        self.replayFile = config['ec2'].get('replay_file')
+
+        # get paths for nagios config
+        self.nagiosDir = os.path.expanduser(config['nagios']['host_dir'])
+        self.hostIdent = config['nagios']['host_identifier']
+        self.nagiosFields = [config['mappings'][map]['nagios_field'] for map in config['mappings']]
+        self.nagiosSplitBy = config['nagios']['separate_hosts_by']
+        # every stage passes hosts around as records of the nagios fields
+        self.hostRecord = makeHostRecord(self.nagiosFields, self.hostIdent)
+        if self.nagiosSplitBy not in self.nagiosFields and self.nagiosSplitBy.lower() != 'none':
+            self.logger.critical('separate_hosts_by not set to a known nagios host field')
+            exit(1)
+
+        # get database config
+        self.dbType = config['database'].get('type', 'sqlite')
+        if self.dbType not in ('sqlite', 'snapshot'):
+            self.logger.critical("Database type: %s, not currently supported. Use sqlite or snapshot" % (self.dbType))
+            exit(1)
+        self.dbFile = os.path.expanduser(config['database']['location'])
+        self.sqliteJournalMode = config['database'].get('journal_mode')
+        self.sqliteSynchronous = config['database'].get('synchronous')
+        self.digestFile = os.path.expanduser(config['database'].get('digest_file', self.dbFile + '.digests'))
+
+        # Restart debouncing, by default every change is verified and restarted straight away
+        self.restartStateFile = os.path.expanduser(config['nagios'].get('restart_state_file',
+                                                                         self.dbFile + '.restart'))
+        self.restartQuietPeriod = config['nagios'].get('restart_quiet_period', 0)
+        self.restartMinInterval = config['nagios'].get('restart_min_interval', 0)
+        self.restartMaxDeferral = config['nagios'].get('restart_max_deferral', 0)
+
+        # Trees identical to one that passed test_config_cmd in the last verify_cache_ttl seconds aren't verified again
+        self.verifyCache = None
+        verifyCacheTtl = config['nagios'].get('verify_cache_ttl', 86400)
+        if verifyCacheTtl:
+            self.verifyCache = NagiosVerifyCache(os.path.expanduser(config['nagios'].get('verify_cache_file',
+                                                                                        self.dbFile + '.verify')),
+                                                 ttl=verifyCacheTtl)
+
+        # Optional sharding of the hosts across several nagios/icinga nodes, each with its own host_dir and commands
+        shards_conf = config['nagios'].get('shards') or {}
+        self.shardTargets = shards_conf.get('targets') or {}
+        self.shardRing = None
+        if self.shardTargets:
+            shardBy = shards_conf.get('by', self.hostIdent)
+            if shardBy not in self.nagiosFields:
+                self.logger.critical('shards: by not set to a known nagios host field')
+                exit(1)
+            for name in self.shardTargets:
+                if not (self.shardTargets[name] or {}).get('host_dir'):
+                    self.logger.critical("Shard target %s has no host_dir" % (name))
+                    exit(1)
+            self.shardRing = NagiosShardRing(self.shardTargets, self.hostIdent, splitBy=shardBy,
+                                             replicas=shards_conf.get('replicas', 100))
+        self.shardStateFile = os.path.expanduser(config['nagios'].get('shard_state_file',
+                                                                       self.dbFile + '.shards'))
+
+        # Grab the bits of the config we need to give to AWSHosts class
+        self.templateMap = config['template_map']
+        self.mappings = config['mappings']
+        self.filters = config['ec2']['filters']
+        if 'exclude_tag' in config['ec2']:
+            self.exclude_tag = config['ec2']['exclude_tag']
+        else:
+            self.exclude_tag = ''
+
+        # Notification config, notifications are sent in the background
+        self.notification_conf = config['notifications']
+        self.notifyFlushTimeout = self.notification_conf.get('flush_timeout', 60)
+        self.notifier = Notifier(self.notification_conf,
+                                 digestInterval=self.notification_conf.get('digest_interval', 0),
+                                 retries=self.notification_conf.get('retries', 3),
+                                 maxMessageBytes=self.notification_conf.get('max_message_bytes',
+                                                                            Notifier.MAX_MESSAGE_BYTES),
+                                 metrics=self.metrics)
+
+        # Where to export run metrics to
+        self.metrics_conf = config.get('metrics') or {}
+
+        # Event driven discovery, by default every run discovers the whole fleet
+        events_conf = config.get('events') or {}
+        self.eventSpoolFile = events_conf.get('spool_file')
+        self.eventQueue = events_conf.get('sqs_queue')
+        self.eventQueueRegion = events_conf.get('sqs_region', self.region[0] if type(self.region) is list
+                                                else self.region)
+        self.eventQueueWait = events_conf.get('sqs_wait_time', 0)
+        self.reconcileInterval = events_conf.get('reconcile_interval', 3600)
+        if self.eventSpoolFile and self.eventQueue:
+            self.logger.critical('Only one of events: spool_file and sqs_queue can be set')
+            exit(1)
+
+        # Daemon mode polling config
+        daemon_conf = config.get('daemon') or {}
+        self.interval = daemon_conf.get('interval', 60)
+        self.jitter = daemon_conf.get('jitter', 10)
+
+    def runForever(self):
+        """
+        Runs every interval seconds (plus up to jitter seconds, so several instances don't poll in step).
+        Failed runs are logged and retried on the next poll. Only config errors, found when the first run sets
+        things up, exit.
+        """
+        self.logger.info("Running as a daemon, polling every %s seconds" % (self.interval))
+        while True:
+            started = time.time()
+            try:
+                self.run()
+            except Exception:
+                self.logger.exception('Cloudgazer run failed')
+            elapsed = time.time() - started
+            time.sleep(max(0, self.interval - elapsed) + random.uniform(0, self.jitter))
+
+    def run(self):
+        """
+        Runs once, timing each stage, and exports the run's metrics
+        """
+        self.metrics.reset()
+        try:
+            with self.metrics.timer('run'):
+                self._run()
+            # the events have been applied, don't see them again
+            if self.eventSource:
+                self.eventSource.ack()
+        finally:
+            self.metrics.export(self.metrics_conf)
+
+    def close(self):
+        """
+        Sends any notifications still queued, call before exiting
+        """
+        self.notifier.close(timeout=self.notifyFlushTimeout)
+
+    def _discover(self):
+        """
+        Discovers the fleet, or when consuming events and a full reconciliation isn't due just the instances that
+        changed state. Returns False if there were no events so nothing can have changed.
+        """
+        if self.eventSource is None and (self.eventSpoolFile or self.eventQueue):
+            if self.eventSpoolFile:
+                self.eventSource = SpoolEvents(os.path.expanduser(self.eventSpoolFile))
+            else:
+                self.eventSource = SQSEvents(self.eventQueue, self.eventQueueRegion, waitTime=self.eventQueueWait)
+        events = self.eventSource.poll() if self.eventSource else []
+        self.metrics.incr('events_received', len(events))
+
+        now = time.time()
+        if self.awsHosts is not None and self.eventSource and now - self.lastReconcile < self.reconcileInterval:
+            if not events:
+                return False
+            changes = self.awsHosts.applyEvents(events)
+            self.logger.debug("Applied %d state change events, %d hosts changed" % (len(events), changes))
+            return True
+
+        # a full discovery covers any events too
+        self.lastReconcile = now
+        if self.awsHosts is None:
+            self.awsHosts = AWSHosts(region=self.region,
+                                     assumed_role_arn=self.assumed_role_arn,
+                                     filters=self.filters,
+                                     mappings=self.mappings,
+                                     templateMap=self.templateMap,
+                                     exclude_tag=self.exclude_tag,
+                                     maxWorkers=self.maxWorkers,
+                                     callTimeout=self.callTimeout,
+                                     retries=self.retries,
+                                     pageSize=self.pageSize,
+                                     endpoint=self.endpoint,
+                                     metrics=self.metrics,
+                                     recordFile=self.recordFile and os.path.expanduser(self.recordFile),
+                                     replayFile=self.replayFile and os.path.expanduser(self.replayFile),
+                                     recordType=self.hostRecord,
+                                     profiler=self.profiler)
         else:
-            self.notifications_enabled = True
-
-        # if its a host change notification,
-        # generate the message from changeHosts dict
-        if type == 'host_change':
-            self.message = self._generate_host_change_message(changedHosts)
-        # only other type we have at the moment is an error
-        # so if not host_change, assume its an error
+            self.awsHosts.refresh()
+        return True
+
+    def _run(self):
+        logger = self.logger
+        metrics = self.metrics
+        with metrics.timer('discovery'):
+            discovered = self._discover()
+        awsHosts = self.awsHosts
+        metrics.gauge('hosts_discovered', len(awsHosts.hosts))
+
+        if logger.isEnabledFor(logging.DEBUG):
+            for host in awsHosts.hosts:
+                for field, value in host.items():
+                    logger.debug("Host: %s, Nagios field: %s, Value: %s" % (host.ident(), field, value))
+
+        if self.restartScheduler is None:
+            self.restartScheduler = NagiosRestartScheduler(stateFile=self.restartStateFile,
+                                                           hostIdent=self.hostIdent,
+                                                           quietPeriod=self.restartQuietPeriod,
+                                                           minInterval=self.restartMinInterval,
+                                                           maxDeferral=self.restartMaxDeferral,
+                                                           recordType=self.hostRecord)
+        # changes taken by a run that died before publishing them are only in the restart state now
+        self.restartScheduler.requeue()
+        # hosts need rewriting to different shard targets when the targets have changed
+        layoutChanged = self.shardRing is not None and self._getShardLayout() != self.shardRing.signature()
+        # targets whose last publish failed, so their live config is behind the database until rewritten in full
+        retryTargets = [target for target in self.restartScheduler.retryTargets()
+                        if target in [name or '' for name, nagiosConfig in self._getTargets()]]
+        if not discovered and not self.restartScheduler.pending() and not layoutChanged and not retryTargets:
+            logger.debug('No instance state changes. Nothing to do.')
+            return
+
+        # skip loading and diffing the stored hosts if the discovered hosts hash the same as when we last stored them
+        if self.hostDigests is None:
+            self.hostDigests = NagiosHostDigests(digestFile=self.digestFile,
+                                                 hostIdent=self.hostIdent,
+                                                 nagiosFields=self.nagiosFields,
+                                                 splitBy=self.nagiosSplitBy)
+        with metrics.timer('digest'):
+            self.hostDigests.compute(awsHosts.hosts)
+        if self.nagiosConf is None:
+            self.nagiosConf = NagiosConfig(configPath=self.nagiosDir,
+                                           databaseFile=self.dbFile,
+                                           hostIdent=self.hostIdent,
+                                           nagiosFields=self.nagiosFields,
+                                           journalMode=self.sqliteJournalMode,
+                                           synchronous=self.sqliteSynchronous,
+                                           recordType=self.hostRecord,
+                                           databaseType=self.dbType)
+        # a new (or deleted and recreated) database has none of the hosts the stored digests describe
+        storeEmpty = self.nagiosConf.empty()
+        schemaChanged = False
+        commitDB = None
+        if self.hostDigests.unchanged() and not storeEmpty:
+            if not self.restartScheduler.pending() and not layoutChanged and not retryTargets:
+                logger.debug('Host digest unchanged. Nothing to do.')
+                return
+            changedHosts = {}
         else:
-            self.message = "On host: %s \n" % (self.hostname)
-            if message:
-                self.message += 'Cloudgazer encounted the following error:\n\n'
-                self.message += message
+            changedBuckets = None if storeEmpty else self.hostDigests.changedBuckets()
+            if changedBuckets is not None:
+                logger.debug("Host digests changed for %s" % (', '.join(sorted(changedBuckets))))
+            # find the changes now, and write them to the database alongside writing the config
+            with metrics.timer('diff'):
+                changedHosts = self.nagiosConf.updateDB(awsHosts.hosts,
+                                                        splitField=self.nagiosSplitBy,
+                                                        buckets=changedBuckets,
+                                                        commit=False)
+            for change in changedHosts.values():
+                metrics.incr('hosts_' + change.split(':')[0])
+            # new mappings change every host's config, without being a change to the hosts
+            schemaChanged = self.nagiosConf.schemaChanged
+            if schemaChanged:
+                metrics.incr('schema_migrations')
+            self.restartScheduler.add(changedHosts, self.nagiosConf.previousHosts)
+            commitDB = self._commitDB
+
+        if self.restartScheduler.pending() and not self.restartScheduler.due() and not schemaChanged:
+            if commitDB:
+                commitDB()
+            logger.info('Host list changed, deferring nagios restart to merge it with further changes')
+            return
+        # apply every change held since the last restart in one write, verify and restart
+        changedHosts, previousHosts = self.restartScheduler.take() if self.restartScheduler.pending() else ({}, [])
+
+        if len(changedHosts) > 0 or layoutChanged or schemaChanged or retryTargets:
+            logger.debug('Host list changed, writing nagios config')
+            targets = self._getTargets()
+            if self.shardRing:
+                hostsByTarget = self.shardRing.split(awsHosts.hosts)
+                previousByTarget = self.shardRing.split(previousHosts)
             else:
-                self.message += 'Cloudgazer encounted an unknown error,' \
-                                ' please investigate.\n\n'
-
-        # Send notifications unless the config specifically
-        # disables it, otherwise just log
-        if self.notifications_enabled:
-            if method == 'SNS':
-                sns = SNSNotify(region=config['sns']['region'],
-                                topic=config['sns']['topic'])
-                sns.publish(message=self.message, subject=subject)
+                hostsByTarget = {None: awsHosts.hosts}
+                previousByTarget = {None: previousHosts}
+            fullWrite = layoutChanged or schemaChanged
+
+            # the database write runs alongside rendering the config, and notifying alongside verifying and
+            # restarting; nagios is only restarted once the database has the changes
+            stages = StageGraph(workers=2 * len(targets) + 2, profiler=self.profiler)
+            publishAfter = []
+            if commitDB:
+                stages.add('update_db', commitDB)
+                publishAfter.append('update_db')
+            if changedHosts:
+                stages.add('notify', lambda: self._notifyChanges(changedHosts))
+            for name, nagiosConfig in targets:
+                writeStage = self._stageName('write', name)
+                stages.add(writeStage, partial(self._writeTarget, nagiosConfig, hostsByTarget[name],
+                                               previousByTarget[name], changedHosts,
+                                               nagiosConfig.get('incremental_write', False) and not fullWrite
+                                               and (name or '') not in retryTargets))
+                stages.add(self._stageName('publish', name),
+                           partial(self._publishTarget, nagiosConfig, stages.results, writeStage),
+                           after=publishAfter + [writeStage])
+            # one at a time, once every target is restarted, as scheduling downtime may switch our effective user
+            # (for every thread, so the notifier is paused too)
+            downtimeAfter = [self._stageName('publish', name) for name, nagiosConfig in targets]
+            for name, nagiosConfig in targets:
+                downtimeStage = self._stageName('downtime', name)
+                stages.add(downtimeStage, partial(self._scheduleDowntime, name, nagiosConfig, stages.results,
+                                                  hostsByTarget[name], changedHosts), after=downtimeAfter)
+                downtimeAfter = downtimeAfter + [downtimeStage]
+            results = stages.run()
+
+            # report each target's outcome in order
+            published = []
+            failed = []
+            for name, nagiosConfig in targets:
+                where = " on shard %s" % (name) if name else ''
+                result = results.get(self._stageName('publish', name))
+                if result is None:
+                    failed.append(name)
+                    continue
+                nag_config_check, restarted = result
+                if not nag_config_check['ok']:
+                    failed.append(name)
+                    msg = 'Failed to verify nagios config' + where
+                    logger.critical(msg)
+                    msg = msg + "\n" + nag_config_check['output']
+                    with metrics.timer('notify'):
+                        self.notifier.error(msg)
+                elif not restarted:
+                    failed.append(name)
+                    msg = 'Failed to restart nagios' + where
+                    logger.critical(msg)
+                    with metrics.timer('notify'):
+                        self.notifier.error(msg)
+                else:
+                    published.append(name or '')
+                    logger.debug('Nagios successfully restarted' + where)
+            if failed:
+                # hold the changes the failed targets didn't get, to write them in full and retry next run
+                failedIdents = set()
+                for name in failed:
+                    failedIdents.update([host.ident() for host in hostsByTarget[name] + previousByTarget[name]
+                                         if host.ident() in changedHosts])
+                self.restartScheduler.retry(dict((ident, changedHosts[ident]) for ident in failedIdents),
+                                            previousHosts, [name or '' for name in failed])
+            self.restartScheduler.published(published)
+            stages.check()
+            if layoutChanged and not failed:
+                self._saveShardLayout()
         else:
-            self.logger.debug('Notifications are disabled.'
-                              "We Would've sent this: %s" % self.message)
-
-    def _generate_host_change_message(self, changedHosts):
-        message = "AWS Hosts in nagios have changed on %s:\n\n" % (self.hostname)
-        hostsAdded = []
-        hostsUpdated = []
-        hostsRemoved = []
-
-        for host in changedHosts:
-            if changedHosts[host] == 'added':
-                hostsAdded.append(host)
-            elif changedHosts[host] == 'removed':
-                hostsRemoved.append(host)
-            elif changedHosts[host].startswith('updated'):
-                fields = []
-                for field in changedHosts[host].split(':'):
-                    if field == 'updated':
-                        continue
-                    fields.append(field)
-                hostsUpdated.append("%s (%s)" % (host, ', '.join(fields)))
-        message += "- New hosts (%s): \n%s\n\n" % (len(hostsAdded), "\n ".join(sorted(hostsAdded)))
-        message += "- Removed hosts (%s): \n%s\n\n" % (len(hostsRemoved), "\n ".join(sorted(hostsRemoved)))
-        message += "- Updated hosts (%s): \n%s\n\n" % (len(hostsUpdated), "\n ".join(sorted(hostsUpdated)))
-
-        return message
+            if commitDB:
+                commitDB()
+            logger.debug('No change to host list. Nothing to do.')
+
+    def _getTargets(self):
+        """
+        Returns (shard name, nagios config) for each target, the target's settings overriding the nagios section.
+        Without sharding there is a single unnamed target.
+        """
+        if self.shardRing is None:
+            return [(None, self.config['nagios'])]
+        return [(name, dict(self.config['nagios'], **self.shardTargets[name])) for name in sorted(self.shardTargets)]
+
+    def _commitDB(self):
+        with self.metrics.timer('update_db'):
+            self.nagiosConf.commitDB()
+        # only once the database has the hosts, so a failed write is found again next run
+        self.hostDigests.save()
+
+    def _notifyChanges(self, changedHosts):
+        with self.metrics.timer('notify'):
+            self.notifier.hostChange(changedHosts)
+
+    def _writeTarget(self, nagiosConfig, hosts, previousHosts, changedHosts, incremental):
+        """
+        Writes a target's host config, to a staged copy of its host_dir when staged_write is on, and returns the
+        stage (or None) for _verifyAndRestart to publish
+        """
+        writeDir = os.path.expanduser(nagiosConfig['host_dir'])
+        stage = None
+        with self.metrics.timer('write'):
+            if nagiosConfig.get('staged_write', False):
+                stage = NagiosStagedConfig(writeDir)
+                writeDir = stage.path
+            writer = NagiosWriter(configDir=writeDir,
+                                  hosts=hosts,
+                                  changedHosts=changedHosts,
+                                  splitBy=self.nagiosSplitBy,
+                                  hostIdent=self.hostIdent,
+                                  previousHosts=previousHosts,
+                                  incremental=incremental,
+                                  nagiosFields=self.nagiosFields)
+        self.metrics.incr('bytes_written', writer.bytesWritten)
+        self.metrics.incr('files_written', len(writer.filesWritten))
+        self.metrics.incr('files_removed', len(writer.filesRemoved))
+        return stage
+
+    def _scheduleDowntime(self, name, nagiosConfig, results, hosts, changedHosts):
+        """
+        Schedules downtime for a target's changed hosts, if its nagios was verified and restarted
+        """
+        result = results.get(self._stageName('publish', name))
+        if result is None or not result[0]['ok'] or not result[1]:
+            return
+        targetChanges = changedHosts
+        if name:
+            targetChanges = dict((host.ident(), changedHosts[host.ident()])
+                                 for host in hosts if host.ident() in changedHosts)
+        if targetChanges:
+            # the notifier's thread would send as whichever user downtime is scheduled as
+            with self.notifier.paused(), self.metrics.timer('downtime'):
+                NagiosDowntime(targetChanges, nagiosConfig['command_file'],
+                               window=nagiosConfig.get('downtime_window', 600),
+                               duration=nagiosConfig.get('downtime_duration', 900),
+                               waitTimeout=nagiosConfig.get('downtime_wait_timeout', 60),
+                               runAs=nagiosConfig.get('downtime_user', 'nagios'))
+            self.logger.debug('Scheduled downtime for hosts' + (" on shard %s" % (name) if name else ''))
+
+    def _publishTarget(self, nagiosConfig, results, writeStage):
+        return self._verifyAndRestart(nagiosConfig, results[writeStage])
+
+    @staticmethod
+    def _stageName(stage, target):
+        return "%s:%s" % (stage, target) if target else stage
+
+    def _verifyAndRestart(self, nagiosConfig, stage=None):
+        validator = None
+        if nagiosConfig.get('prevalidate', True):
+            validator = NagiosValidator(templates=self._getTemplates(nagiosConfig))
+        nagManager = NagiosManager(config=nagiosConfig, validator=validator, verifyCache=self.verifyCache)
+        with self.metrics.timer('verify'):
+            if stage:
+                status = nagManager.verifyAndPublish(stage)
+            else:
+                status = nagManager.verifyConfig()
+        if status.get('cached'):
+            self.metrics.incr('verify_cached')
+        restarted = False
+        if status['ok']:
+            with self.metrics.timer('restart'):
+                restarted = nagManager.restart()
+        return status, restarted
+
+    def _getTemplates(self, nagiosConfig):
+        """
+        Returns the nagios templates hosts may use: the target's templates list, and the values of template_map.
+        None if neither is set, so templates aren't checked.
+        """
+        templates = list(nagiosConfig.get('templates') or [])
+        if isinstance(self.templateMap, dict):
+            templates.extend(self.templateMap.values())
+        return templates or None
+
+    def _getShardLayout(self):
+        try:
+            with open(self.shardStateFile) as f:
+                return f.read().strip()
+        except IOError:
+            return None
+
+    def _saveShardLayout(self):
+        writeAtomically(self.shardStateFile, self.shardRing.signature() + '\n')
+
 
 if __name__ == '__main__':
     main()